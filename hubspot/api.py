@@ -6,14 +6,15 @@ import os
 import time
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import math
-from typing import Dict, List, Any, Optional
-from threading import Lock
-from collections import deque
-from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, List, Any, Optional, Iterable, Iterator
 import sys
-import json
-from pathlib import Path
+from diskcache import FanoutCache
+
+from hubspot.utils import TokenBucket
 
 logger = logging.getLogger(__name__)
 
@@ -27,54 +28,96 @@ elif not API_KEY:
     logger.warning("Using test API key. This will not work for real API calls.")
 
 BASE_URL = 'https://api.hubapi.com'
-headers = {"Authorization": f"Bearer {API_KEY}"}
+
+# Timeout de conexión y de lectura (segundos)
+REQUEST_TIMEOUT = (5, 30)
+
+@lru_cache(maxsize=1)
+def get_session() -> requests.Session:
+    """Devuelve la sesión HTTP compartida, creándola en el primer uso.
+    
+    La sesión reutiliza conexiones (keep-alive) entre peticiones y lleva la
+    cabecera de autorización una sola vez. urllib3 solo reintenta los errores
+    de conexión, en los que la petición no llega a HubSpot; los 429 y 5xx los
+    reintenta make_api_request para que cada reintento pase por el rate limiter.
+    
+    Returns:
+        requests.Session: Sesión configurada para la API de HubSpot
+    """
+    session = requests.Session()
+    session.headers.update({"Authorization": f"Bearer {API_KEY}"})
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=3,
+            read=0,
+            status=0,
+            backoff_factor=1,
+            # Los POST que se hacen son lecturas batch, por lo que es seguro reintentarlos
+            allowed_methods=frozenset(['GET', 'POST'])
+        )
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 # Rate limiting configuration
 RATE_LIMIT = 110  # requests
 RATE_WINDOW = 10  # seconds
-request_timestamps = deque(maxlen=RATE_LIMIT)
-rate_limit_lock = Lock()
+# Ráfaga máxima (capacidad del bucket). La ráfaga más lo repuesto en una ventana
+# no puede superar RATE_LIMIT, así que se repone RATE_LIMIT - RATE_BURST por ventana
+RATE_BURST = 10
+
+# Token bucket compartido por todas las peticiones a la API
+RATE_BUCKET = TokenBucket(RATE_LIMIT, RATE_WINDOW, RATE_BURST)
 
 def wait_for_rate_limit():
     """Espera si es necesario para respetar el límite de tasa de la API.
     
-    HubSpot permite 110 peticiones cada 10 segundos.
+    HubSpot permite 110 peticiones cada 10 segundos. Cada petición reserva un
+    token de RATE_BUCKET y, si no quedan, se duerme (fuera del lock) lo justo
+    hasta que llegue; ninguna ventana de RATE_WINDOW segundos supera el límite.
     """
-    with rate_limit_lock:
-        now = datetime.now()
-        
-        # Eliminar timestamps antiguos (más de 10 segundos)
-        while request_timestamps and (now - request_timestamps[0]) > timedelta(seconds=RATE_WINDOW):
-            request_timestamps.popleft()
-        
-        # Si estamos en el límite, esperar hasta que podamos hacer otra petición
-        if len(request_timestamps) >= RATE_LIMIT:
-            oldest = request_timestamps[0]
-            wait_time = (oldest + timedelta(seconds=RATE_WINDOW) - now).total_seconds()
-            if wait_time > 0:
-                logger.debug(f"Rate limit approaching, waiting {wait_time:.2f} seconds...")
-                time.sleep(wait_time)
-        
-        # Registrar esta petición
-        request_timestamps.append(now)
+    wait_time = RATE_BUCKET.reserve(1)
+    if wait_time > 0:
+        logger.debug(f"Rate limit approaching, waiting {wait_time:.2f} seconds...")
+        time.sleep(wait_time)
+
+# Reintentos de las respuestas 429 y 5xx; se hacen en make_api_request, no en urllib3,
+# para que cada reintento consuma un token del rate limiter
+MAX_RETRIES = 3
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
 
-def handle_rate_limit(response: requests.Response) -> None:
-    """Maneja el rate limiting esperando si es necesario.
+# Espera base (segundos) entre reintentos cuando no hay Retry-After; se duplica en cada uno
+RETRY_BACKOFF = 1
+
+def get_retry_delay(response: requests.Response, attempt: int) -> float:
+    """Calcula cuánto esperar antes de reintentar una petición.
     
     Args:
-        response: Respuesta de la API que contiene información de rate limiting
+        response: Respuesta 429 o 5xx de la API
+        attempt: Número de intento que ha fallado (empezando en 0)
+        
+    Returns:
+        Segundos indicados por Retry-After o, si no hay, backoff exponencial
     """
-    if response.status_code == 429:
-        retry_after = int(response.headers.get('Retry-After', 10))
-        logger.warning(f"Rate limit hit. Waiting {retry_after} seconds...")
-        time.sleep(retry_after)
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, TypeError, ValueError):
+        return RETRY_BACKOFF * 2 ** attempt
 
-def make_api_request(url: str, params: Dict[str, Any]) -> Dict:
+def make_api_request(url: str, params: Dict[str, Any], payload: Optional[Dict[str, Any]] = None) -> Dict:
     """Realiza una solicitud a la API con manejo de rate limiting.
     
+    Usa la sesión compartida, por lo que las conexiones se reutilizan. Los
+    errores transitorios (429, 5xx) se reintentan hasta MAX_RETRIES veces,
+    esperando según Retry-After y pasando de nuevo por el rate limiter.
+    
     Args:
         url: URL de la API
         params: Parámetros de la solicitud
+        payload: Cuerpo JSON; si se indica, la solicitud se hace por POST
         
     Returns:
         Datos de la respuesta en formato JSON
@@ -82,121 +125,239 @@ def make_api_request(url: str, params: Dict[str, Any]) -> Dict:
     Raises:
         requests.exceptions.RequestException: Si la solicitud falla después de los reintentos
     """
-    max_retries = 3
-    for attempt in range(max_retries):
+    for attempt in range(MAX_RETRIES + 1):
+        # Esperar si es necesario para respetar el límite de tasa (también en cada reintento)
+        wait_for_rate_limit()
+        
         try:
-            # Esperar si es necesario para respetar el límite de tasa
-            wait_for_rate_limit()
+            if payload is not None:
+                response = get_session().post(url, params=params, json=payload, timeout=REQUEST_TIMEOUT)
+            else:
+                response = get_session().get(url, params=params, timeout=REQUEST_TIMEOUT)
+            
+            if response.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                delay = get_retry_delay(response, attempt)
+                logger.warning(f"HTTP {response.status_code}, retrying in {delay} seconds "
+                               f"({attempt + 1}/{MAX_RETRIES})...")
+                time.sleep(delay)
+                continue
             
-            response = requests.get(url, headers=headers, params=params)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.HTTPError as e:
-            if response.status_code == 429:
-                handle_rate_limit(response)
-                continue
             logger.error(f"HTTP Error: {e.response.status_code} - {e.response.text}")
             raise
         except requests.exceptions.RequestException as e:
             logger.error(f"Request failed: {e}")
-            if attempt == max_retries - 1:
-                raise
-            time.sleep(2 ** attempt)  # Exponential backoff
-    return {}
+            raise
 
-def get_contacts() -> List[Dict]:
-    """Obtiene todos los contactos de HubSpot con información de la empresa.
+def iter_pages(url: str, params: Dict[str, Any]) -> Iterator[Dict]:
+    """Recorre un listado paginado de la API siguiendo el cursor 'after'.
     
-    Returns:
-        Lista de contactos
+    Es el bucle de paginación que comparten get_contacts y get_engagements, que
+    reúnen el listado completo antes de devolverlo (save_to_csv necesita todos
+    los registros para calcular las columnas).
+    
+    Args:
+        url: URL del listado
+        params: Parámetros de la solicitud (sin el cursor)
+        
+    Yields:
+        Registros del listado
     """
-    contacts = []
-    after = None
+    page_params = dict(params)
     while True:
-        params = {
-            'limit': 100,
-            'properties': ['email', 'firstname', 'lastname', 'company', 'hs_object_id', 'associatedcompanyid']
-        }
-        if after:
-            params['after'] = after
-        
-        data = make_api_request(f'{BASE_URL}/crm/v3/objects/contacts', params)
-        contacts.extend(data.get('results', []))
+        data = make_api_request(url, page_params)
+        yield from data.get('results', [])
         
         if 'paging' in data and 'next' in data['paging']:
-            after = data['paging']['next']['after']
+            page_params = {**params, 'after': data['paging']['next']['after']}
         else:
             break
-    return contacts
+
+def get_contacts() -> List[Dict]:
+    """Obtiene todos los contactos de HubSpot con información de la empresa.
+    
+    Returns:
+        Lista de contactos
+    """
+    return list(iter_pages(f'{BASE_URL}/crm/v3/objects/contacts', {
+        'limit': 100,
+        'properties': ['email', 'firstname', 'lastname', 'company', 'hs_object_id', 'associatedcompanyid']
+    }))
+
+def normalize_id(id_value: Any) -> Optional[str]:
+    """Valida un ID y lo normaliza a la forma que espera la API ("123").
+    
+    Hace la validación y la conversión en una sola pasada, despachando por tipo
+    para no convertir a string los valores que ya son numéricos.
+    
+    Args:
+        id_value: Valor del ID (int, float, string, NaN, None...)
+        
+    Returns:
+        ID como string de entero sin decimales, o None si no es válido
+    """
+    if id_value is None:
+        return None
+    if isinstance(id_value, int):
+        return str(id_value)
+    if isinstance(id_value, float):
+        return str(int(id_value)) if math.isfinite(id_value) else None
+    
+    value = str(id_value).strip()
+    if not value or value.lower() == 'nan':
+        return None
+    try:
+        return str(int(float(value)))
+    except (ValueError, OverflowError):
+        return None
 
 def is_valid_id(id_value: Any) -> bool:
     """Verifica si un ID es válido (no es NaN, None, etc.).
     
+    Un ID es válido si normalize_id puede normalizarlo, de modo que ambas
+    funciones comparten una única definición de ID válido.
+    
     Args:
         id_value: Valor del ID a verificar
         
     Returns:
         True si el ID es válido, False en caso contrario
     """
-    if id_value is None:
-        return False
+    return normalize_id(id_value) is not None
+
+def fetch_company(company_id_int: str) -> Dict:
+    """Obtiene una empresa desde la caché en disco o, si no está, desde la API.
     
-    # Convertir a string para verificar si es 'nan' o vacío
-    if str(id_value).lower() == 'nan' or str(id_value).strip() == '':
-        return False
+    No memoriza nada: la única caché en memoria es el diccionario que el
+    llamador pasa a get_company.
     
-    # Verificar si es un número float NaN
-    if isinstance(id_value, float) and math.isnan(id_value):
-        return False
+    Args:
+        company_id_int: ID normalizado de la empresa
+        
+    Returns:
+        Información de la empresa
+    """
+    # Primero intentar cargar desde disco
+    cached_company = load_company_from_disk(company_id_int)
+    if cached_company:
+        company_name = cached_company.get('properties', {}).get('name', 'Desconocida')
+        logger.info(f"📂 Empresa cargada desde caché: ID={company_id_int}, Nombre='{company_name}'")
+        return cached_company
     
-    return True
+    # Si no está en disco, obtener de la API
+    logger.info(f"🔄 Obteniendo empresa {company_id_int} desde la API de HubSpot...")
+    data = make_api_request(f'{BASE_URL}/crm/v3/objects/companies/{company_id_int}', {
+        'properties': ['name', 'domain']
+    })
+    
+    if data:
+        company_name = data.get('properties', {}).get('name', 'Desconocida')
+        logger.info(f"✅ Empresa obtenida de API: ID={company_id_int}, Nombre='{company_name}'")
+        
+        # Guardar en disco para futuras consultas
+        save_company_to_disk(company_id_int, data)
+        logger.info(f"💾 Empresa {company_id_int} guardada en disco")
+        
+    return data
 
-def get_company(company_id: Any) -> Dict:
+def get_company(company_id: Any, cache: Optional[Dict[str, Dict]] = None) -> Dict:
     """Obtiene información de una empresa específica.
     
     Args:
         company_id: ID de la empresa
+        cache: Diccionario opcional de ID normalizado a empresa que se consulta
+            antes que la caché en disco y en el que se guarda el resultado (p. ej.
+            el devuelto por get_companies). Es la única caché en memoria de empresas
         
     Returns:
-        Información de la empresa
+        Información de la empresa; si viene de cache es el mismo objeto, sin copiar,
+        así que no se debe modificar
     """
-    # Verificar si el ID es válido
-    if not is_valid_id(company_id):
+    company_id_int = normalize_id(company_id)
+    if company_id_int is None:
         logger.debug(f"Skipping invalid company ID: {company_id}")
         return {}
     
+    if cache is not None and company_id_int in cache:
+        return cache[company_id_int]
+    
     try:
-        # Convertir el ID a entero eliminando cualquier parte decimal
-        company_id_int = str(int(float(company_id)))
+        company_data = fetch_company(company_id_int)
+    except Exception as e:
+        logger.error(f"Error getting company info for ID {company_id}: {e}")
+        company_data = {}
+    
+    # También se guardan los fallos para no repetir la petición en esta ejecución
+    if cache is not None:
+        cache[company_id_int] = company_data
+    return company_data
+
+# Máximo de IDs que admite el endpoint batch/read de HubSpot
+COMPANY_BATCH_SIZE = 100
+
+def get_companies_batch(company_ids: List[str]) -> Dict[str, Dict]:
+    """Obtiene varias empresas de la API usando el endpoint batch/read.
+    
+    Las peticiones se hacen en bloques de COMPANY_BATCH_SIZE IDs, de modo que
+    100 empresas cuestan una sola petición en lugar de 100.
+    
+    Args:
+        company_ids: IDs normalizados de las empresas
         
-        # Primero intentar cargar desde disco
-        cached_company = load_company_from_disk(company_id_int)
-        if cached_company:
-            company_name = cached_company.get('properties', {}).get('name', 'Desconocida')
-            logger.info(f"📂 Empresa cargada desde caché: ID={company_id_int}, Nombre='{company_name}'")
-            return cached_company
+    Returns:
+        Diccionario de ID de empresa a información de la empresa
+    """
+    companies = {}
+    for start in range(0, len(company_ids), COMPANY_BATCH_SIZE):
+        chunk = company_ids[start:start + COMPANY_BATCH_SIZE]
+        try:
+            logger.info(f"🔄 Obteniendo {len(chunk)} empresas desde la API de HubSpot (batch)...")
+            data = make_api_request(f'{BASE_URL}/crm/v3/objects/companies/batch/read', {}, {
+                'properties': ['name', 'domain'],
+                'inputs': [{'id': company_id} for company_id in chunk]
+            })
+            for company in data.get('results', []):
+                companies[str(company.get('id'))] = company
+        except Exception as e:
+            logger.error(f"Error getting company batch starting at ID {chunk[0]}: {e}")
+    return companies
+
+def get_companies(company_ids: Iterable[Any]) -> Dict[str, Dict]:
+    """Obtiene información de varias empresas.
+    
+    Primero se cargan desde la caché en disco y las que faltan se piden a la
+    API en bloques, guardándolas en disco para futuras consultas.
+    
+    Args:
+        company_ids: IDs de las empresas (se ignoran los inválidos y repetidos)
         
-        # Si no está en disco, obtener de la API
-        logger.info(f"🔄 Obteniendo empresa {company_id_int} desde la API de HubSpot...")
-        data = make_api_request(f'{BASE_URL}/crm/v3/objects/companies/{company_id_int}', {
-            'properties': ['name', 'domain']
-        })
+    Returns:
+        Diccionario de ID normalizado de empresa a información de la empresa
+    """
+    companies = {}
+    missing_ids = []
+    seen_ids = set()
+    for company_id in company_ids:
+        company_id_int = normalize_id(company_id)
+        if company_id_int is None or company_id_int in seen_ids:
+            continue
+        seen_ids.add(company_id_int)
         
-        if data:
-            company_name = data.get('properties', {}).get('name', 'Desconocida')
-            logger.info(f"✅ Empresa obtenida de API: ID={company_id_int}, Nombre='{company_name}'")
-            
-            # Guardar en disco para futuras consultas
-            save_company_to_disk(company_id_int, data)
-            logger.info(f"💾 Empresa {company_id_int} guardada en disco")
-            
-        return data
-    except (ValueError, TypeError) as e:
-        logger.error(f"Invalid company ID format: {company_id} - {e}")
-        return {}
-    except Exception as e:
-        logger.error(f"Error getting company info for ID {company_id}: {e}")
-        return {}
+        cached_company = load_company_from_disk(company_id_int)
+        if cached_company:
+            companies[company_id_int] = cached_company
+        else:
+            missing_ids.append(company_id_int)
+    
+    logger.info(f"📂 {len(companies)} empresas cargadas desde caché, {len(missing_ids)} pendientes de la API")
+    
+    for company_id_int, company_data in get_companies_batch(missing_ids).items():
+        companies[company_id_int] = company_data
+        save_company_to_disk(company_id_int, company_data)
+    
+    return companies
 
 def get_engagements(engagement_type: str) -> List[Dict]:
     """Obtiene todos los engagements de un tipo específico.
@@ -207,21 +368,7 @@ def get_engagements(engagement_type: str) -> List[Dict]:
     Returns:
         Lista de engagements
     """
-    engagements = []
-    after = None
-    while True:
-        params = {'limit': 100}
-        if after:
-            params['after'] = after
-        
-        data = make_api_request(f'{BASE_URL}/crm/v3/objects/{engagement_type}', params)
-        engagements.extend(data.get('results', []))
-        
-        if 'paging' in data and 'next' in data['paging']:
-            after = data['paging']['next']['after']
-        else:
-            break
-    return engagements
+    return list(iter_pages(f'{BASE_URL}/crm/v3/objects/{engagement_type}', {'limit': 100}))
 
 def get_email_content(email_id: Any) -> Dict:
     """Obtiene el contenido detallado de un email específico.
@@ -232,15 +379,12 @@ def get_email_content(email_id: Any) -> Dict:
     Returns:
         Contenido detallado del email
     """
-    # Verificar si el ID es válido
-    if not is_valid_id(email_id):
+    email_id_int = normalize_id(email_id)
+    if email_id_int is None:
         logger.debug(f"Skipping invalid email ID: {email_id}")
         return {}
     
     try:
-        # Convertir el ID a entero eliminando cualquier parte decimal
-        email_id_int = str(int(float(email_id)))
-        
         logger.info(f"Obteniendo email con ID {email_id_int} de la API de HubSpot...")
         data = make_api_request(f'{BASE_URL}/crm/v3/objects/emails/{email_id_int}', {
             'properties': ['hs_email_subject', 'hs_email_text', 'hs_timestamp', 'hs_email_status', 
@@ -254,9 +398,6 @@ def get_email_content(email_id: Any) -> Dict:
             logger.warning(f"No se pudo obtener datos para el email con ID {email_id_int}")
             
         return data
-    except (ValueError, TypeError) as e:
-        logger.error(f"Invalid email ID format: {email_id} - {e}")
-        return {}
     except Exception as e:
         logger.error(f"Error getting email content for ID {email_id}: {e}")
         return {}
@@ -264,30 +405,22 @@ def get_email_content(email_id: Any) -> Dict:
 # Directorio para guardar la información de empresas
 COMPANIES_CACHE_DIR = 'companies_cache'
 
-def ensure_directory(directory_path: str) -> str:
-    """Asegura que un directorio exista, creándolo si es necesario.
-    
-    Args:
-        directory_path: Ruta del directorio
-        
-    Returns:
-        Ruta del directorio creado
-    """
-    path = Path(directory_path)
-    path.mkdir(parents=True, exist_ok=True)
-    return str(path)
+# Configuración de la caché de empresas (SQLite repartido en varios shards)
+COMPANIES_CACHE_SHARDS = 8
+COMPANIES_CACHE_SIZE_LIMIT = 2 ** 30  # bytes
 
-def get_company_cache_path(company_id: str) -> str:
-    """Obtiene la ruta del archivo de caché para una empresa.
+@lru_cache(maxsize=1)
+def get_company_cache() -> FanoutCache:
+    """Devuelve la caché en disco de empresas, abriéndola en el primer uso.
+    
+    Es una diskcache.FanoutCache: cada empresa es una entrada de SQLite en lugar
+    de un archivo JSON, y los shards permiten escrituras concurrentes desde los
+    hilos de descarga sin bloquearse entre sí.
     
-    Args:
-        company_id: ID de la empresa
-        
     Returns:
-        Ruta del archivo de caché
+        Caché de empresas
     """
-    ensure_directory(COMPANIES_CACHE_DIR)
-    return os.path.join(COMPANIES_CACHE_DIR, f"company_{company_id}.json")
+    return FanoutCache(COMPANIES_CACHE_DIR, shards=COMPANIES_CACHE_SHARDS, size_limit=COMPANIES_CACHE_SIZE_LIMIT)
 
 def save_company_to_disk(company_id: str, company_data: Dict) -> None:
     """Guarda la información de una empresa en disco.
@@ -297,12 +430,8 @@ def save_company_to_disk(company_id: str, company_data: Dict) -> None:
         company_data: Datos de la empresa
     """
     try:
-        cache_path = get_company_cache_path(company_id)
-        with open(cache_path, 'w', encoding='utf-8') as f:
-            json.dump(company_data, f, ensure_ascii=False, indent=2)
-            f.flush()
-            os.fsync(f.fileno())
-        logger.debug(f"Información de empresa {company_id} guardada en {cache_path}")
+        get_company_cache().set(company_id, company_data)
+        logger.debug(f"Información de empresa {company_id} guardada en {COMPANIES_CACHE_DIR}")
     except Exception as e:
         logger.error(f"Error al guardar información de empresa {company_id}: {e}")
 
@@ -316,13 +445,10 @@ def load_company_from_disk(company_id: str) -> Optional[Dict]:
         Datos de la empresa o None si no existe
     """
     try:
-        cache_path = get_company_cache_path(company_id)
-        if os.path.exists(cache_path):
-            with open(cache_path, 'r', encoding='utf-8') as f:
-                company_data = json.load(f)
-            logger.debug(f"Información de empresa {company_id} cargada desde {cache_path}")
-            return company_data
-        return None
+        company_data = get_company_cache().get(company_id)
+        if company_data is not None:
+            logger.debug(f"Información de empresa {company_id} cargada desde {COMPANIES_CACHE_DIR}")
+        return company_data
     except Exception as e:
         logger.error(f"Error al cargar información de empresa {company_id}: {e}")
         return None
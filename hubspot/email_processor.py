@@ -7,16 +7,32 @@ import pandas as pd
 import os
 import sys
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Dict, Optional, Set
+from functools import lru_cache
 from datetime import datetime
+from concurrent.futures import Executor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from contextlib import nullcontext
 import dateutil.parser
 
-from hubspot.api import get_email_content, get_company, is_valid_id
-from hubspot.utils import sanitize_filename, get_email_filename, ensure_directory
-from hubspot.summarizer import process_email_file
+from hubspot.api import get_email_content, get_company, get_companies, normalize_id
+from hubspot.utils import sanitize_filename, get_email_filename, ensure_directory, EMAIL_BODY_SEPARATOR
+from hubspot.summarizer import process_email_file, SUMMARY_CONCURRENCY
 
 logger = logging.getLogger(__name__)
 
+# Formato de fecha usado en la cabecera de los emails guardados
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Columnas de los CSV que se usan al descargar los emails
+EMAIL_COLUMNS = {'properties.hs_object_id', 'properties.hs_email_to_email'}
+CONTACT_COLUMNS = {'id', 'properties.email', 'properties.associatedcompanyid', 'firstname', 'lastname', 'email'}
+
+# Número de directorios de email (empresa/contacto) que se memorizan
+EMAIL_DIRECTORY_CACHE_SIZE = 4096
+
+# Número de descargas de emails en paralelo (el rate limiter de la API sigue aplicando)
+MAX_WORKERS = 16
+
 def format_date(date_value):
     """Formatea una fecha desde diferentes formatos a una cadena legible.
     
@@ -30,12 +46,23 @@ def format_date(date_value):
         if date_value is None:
             return "Unknown"
         
+        # Camino rápido: hs_timestamp suele ser un timestamp numérico en ms
+        if isinstance(date_value, (int, float)) or (isinstance(date_value, str) and date_value.isdigit()):
+            try:
+                timestamp = int(date_value)
+                # Si el timestamp es muy grande (ms), convertir a segundos
+                if timestamp > 1000000000000:
+                    timestamp //= 1000
+                return datetime.fromtimestamp(timestamp).strftime(DATE_FORMAT)
+            except (ValueError, OverflowError, OSError) as e:
+                logger.debug(f"Error parsing timestamp: {e}")
+        
         # Si es un string que parece una fecha ISO
         if isinstance(date_value, str) and ('T' in date_value or '-' in date_value):
             try:
                 # Intentar parsear como fecha ISO
                 dt = dateutil.parser.parse(date_value)
-                return dt.strftime('%Y-%m-%d %H:%M:%S')
+                return dt.strftime(DATE_FORMAT)
             except Exception as e:
                 logger.debug(f"Error parsing ISO date: {e}")
         
@@ -46,7 +73,7 @@ def format_date(date_value):
             # Si el timestamp es muy grande (ms), convertir a segundos
             if timestamp > 1000000000000:  # Probablemente en milisegundos
                 timestamp = timestamp / 1000
-            return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+            return datetime.fromtimestamp(timestamp).strftime(DATE_FORMAT)
         except Exception as e:
             logger.debug(f"Error parsing timestamp: {e}")
         
@@ -56,7 +83,51 @@ def format_date(date_value):
         logger.error(f"Error formatting date {date_value}: {e}")
         return "Unknown"
 
-def save_email_content(email_data: Dict, contact_info: Dict, company_info: Dict, base_dir: str, force: bool = False, summarize: bool = False) -> bool:
+@lru_cache(maxsize=EMAIL_DIRECTORY_CACHE_SIZE)
+def get_email_directory(base_dir: str, *folders: Optional[str]) -> Path:
+    """Obtiene (y crea) el directorio donde guardar un email.
+    
+    Recibe los nombres de carpeta sin sanitizar; como se repiten mucho entre
+    emails de la misma empresa y contacto, el resultado se memoriza.
+    
+    Args:
+        base_dir: Directorio base para guardar los emails
+        folders: Nombres de las carpetas anidadas (empresa, contacto...)
+        
+    Returns:
+        Objeto Path del directorio
+    """
+    return ensure_directory(Path(base_dir).joinpath(*(sanitize_filename(folder) for folder in folders)))
+
+def summarize_saved_email(file_path: Path, summary_executor: Optional[Executor] = None,
+                          submitted_summaries: Optional[Set[Path]] = None) -> None:
+    """Genera el resumen de un email guardado, en segundo plano si hay un executor.
+    
+    Los emails que ya tienen resumen se omiten, igual que los que ya se enviaron
+    a resumir en esta ejecución: un resumen en segundo plano puede no haber
+    terminado cuando otra fila del CSV vuelve a guardar el mismo email.
+    
+    Args:
+        file_path: Ruta del archivo del email
+        summary_executor: Executor donde generar el resumen; si es None se genera en el momento
+        submitted_summaries: Rutas de los emails ya enviados a resumir en esta ejecución
+    """
+    if submitted_summaries is not None:
+        if file_path in submitted_summaries:
+            logger.debug("El resumen ya está en curso para %s, omitiendo...", file_path.name)
+            return
+        submitted_summaries.add(file_path)
+    
+    if file_path.with_suffix('.summary.json').exists():
+        logger.debug("El resumen ya existe para %s, omitiendo...", file_path.name)
+    elif summary_executor is not None:
+        summary_executor.submit(process_email_file, file_path)
+    else:
+        process_email_file(file_path)
+
+def save_email_content(email_data: Dict, contact_info: Dict, company_info: Dict, base_dir: str, force: bool = False,
+                       summarize: bool = False, summary_executor: Optional[Executor] = None,
+                       submitted_summaries: Optional[Set[Path]] = None) -> bool:
     """Guarda el contenido del email en una estructura organizada por empresa y contacto.
     
     Args:
@@ -66,6 +137,8 @@ def save_email_content(email_data: Dict, contact_info: Dict, company_info: Dict,
         base_dir: Directorio base para guardar los emails
         force: Si se debe forzar la descarga aunque el archivo exista
         summarize: Si se debe generar un resumen del email usando OpenAI
+        summary_executor: Executor donde generar los resúmenes sin bloquear el guardado
+        submitted_summaries: Rutas de los emails ya enviados a resumir en esta ejecución
         
     Returns:
         True si se guardó el email, False si se omitió
@@ -89,22 +162,19 @@ def save_email_content(email_data: Dict, contact_info: Dict, company_info: Dict,
         if is_from_bondo and to_email_address:
             # Si el email viene de bondo.es, guardar en el directorio del destinatario
             logger.info(f"Email de bondo.es detectado, guardando en directorio del destinatario: {to_email_address}")
-            contact_folder = sanitize_filename(to_email_address)
-            email_dir = ensure_directory(Path(base_dir) / contact_folder)
+            email_dir = get_email_directory(base_dir, to_email_address)
         else:
             # Estructura normal organizada por empresa y contacto
-            # Obtener nombres sanitizados para las carpetas
-            company_name = sanitize_filename(company_info.get('properties', {}).get('name', 'unknown_company'))
+            company_name = company_info.get('properties', {}).get('name', 'unknown_company')
             
             # Usar email como nombre de carpeta si está disponible, de lo contrario usar nombre del contacto
             if to_email_address and to_email_address.strip():
-                contact_folder = sanitize_filename(to_email_address)
+                contact_folder = to_email_address
             else:
-                contact_name = sanitize_filename(f"{contact_info.get('firstname', '')} {contact_info.get('lastname', '')}".strip())
-                contact_folder = contact_name if contact_name else 'unknown_contact'
+                contact_folder = f"{contact_info.get('firstname', '')} {contact_info.get('lastname', '')}".strip()
 
             # Crear estructura de directorios
-            email_dir = ensure_directory(Path(base_dir) / company_name / contact_folder)
+            email_dir = get_email_directory(base_dir, company_name, contact_folder)
 
         # Generar nombre de archivo
         filename = get_email_filename(properties, email_id)
@@ -115,7 +185,7 @@ def save_email_content(email_data: Dict, contact_info: Dict, company_info: Dict,
             logger.debug(f"Email {email_id} already exists at {file_path}, skipping...")
             # Si se solicita resumir y el archivo existe, intentar resumirlo
             if summarize:
-                process_email_file(file_path)
+                summarize_saved_email(file_path, summary_executor, submitted_summaries)
             return False
 
         # Guardar contenido del email
@@ -127,22 +197,24 @@ def save_email_content(email_data: Dict, contact_info: Dict, company_info: Dict,
             # Formatear la fecha correctamente
             email_date = format_date(properties.get('hs_timestamp'))
             
+            # Componer el archivo completo y escribirlo de una sola vez
+            payload = (
+                f"Subject: {properties.get('hs_email_subject', '')}\n"
+                f"From: {properties.get('hs_email_from_email', '')}\n"
+                f"To: {properties.get('hs_email_to_email', '')}\n"
+                f"Date: {email_date}\n"
+                f"Email ID: {email_id}\n"
+                f"{EMAIL_BODY_SEPARATOR}"
+                f"{text_content}"
+            )
             with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(f"Subject: {properties.get('hs_email_subject', '')}\n")
-                f.write(f"From: {properties.get('hs_email_from_email', '')}\n")
-                f.write(f"To: {properties.get('hs_email_to_email', '')}\n")
-                f.write(f"Date: {email_date}\n")
-                f.write(f"Email ID: {email_id}\n")
-                f.write("\n" + "="*50 + "\n\n")
-                f.write(text_content)
-                f.flush()
-                os.fsync(f.fileno())
+                f.write(payload)
             
             logger.info(f"✅ EMAIL GUARDADO | ID: {email_id} | Archivo: {file_path}")
             
             # Generar resumen si se solicita
             if summarize:
-                process_email_file(file_path)
+                summarize_saved_email(file_path, summary_executor, submitted_summaries)
                 
             return True
         else:
@@ -152,7 +224,8 @@ def save_email_content(email_data: Dict, contact_info: Dict, company_info: Dict,
         logger.error(f"Error saving email content for ID {email_id}: {e}")
     return False
 
-def download_email_contents(emails_csv: str, output_dir: str, force: bool = False, summarize: bool = False) -> None:
+def download_email_contents(emails_csv: str, output_dir: str, force: bool = False, summarize: bool = False,
+                            max_workers: int = MAX_WORKERS, summary_concurrency: int = SUMMARY_CONCURRENCY) -> None:
     """Descarga y guarda el contenido completo de todos los emails organizados por empresa y contacto.
     
     Args:
@@ -160,6 +233,8 @@ def download_email_contents(emails_csv: str, output_dir: str, force: bool = Fals
         output_dir: Directorio de salida para los emails
         force: Si se debe forzar la descarga aunque el archivo exista
         summarize: Si se debe generar un resumen del email usando OpenAI
+        max_workers: Número de hilos que descargan emails de la API en paralelo
+        summary_concurrency: Número de resúmenes que se generan en paralelo si summarize es True
     """
     try:
         # Crear directorio base si no existe
@@ -168,31 +243,30 @@ def download_email_contents(emails_csv: str, output_dir: str, force: bool = Fals
         
         # Cargar datos
         logger.info(f"Cargando datos desde {emails_csv}...")
-        emails_df = pd.read_csv(emails_csv)
-        contacts_df = pd.read_csv('hubspot_contacts.csv')
+        # Leer solo las columnas que se usan (las que no existan se ignoran)
+        emails_df = pd.read_csv(emails_csv, usecols=lambda column: column in EMAIL_COLUMNS)
+        contacts_df = pd.read_csv('hubspot_contacts.csv', usecols=lambda column: column in CONTACT_COLUMNS)
         
         # Crear diccionarios para búsqueda rápida
         contacts_dict = {}
         companies_dict = {}
         
         logger.info("Loading contact and company information...")
-        for _, contact in contacts_df.iterrows():
+        for contact in contacts_df.to_dict('records'):
             contact_id = contact.get('id')
             if contact_id:
-                contacts_dict[str(contact_id)] = contact.to_dict()
-                
-                # Obtener información de la empresa si no la tenemos ya
-                company_id = contact.get('properties.associatedcompanyid')
-                if is_valid_id(company_id) and str(company_id) not in companies_dict:
-                    try:
-                        # Asegurarse de que el company_id sea un string
-                        company_id_str = str(company_id)
-                        # Ahora get_company primero intentará cargar desde disco
-                        company_info = get_company(company_id_str)
-                        if company_info:
-                            companies_dict[company_id_str] = company_info
-                    except Exception as e:
-                        logger.error(f"Error processing company ID {company_id}: {e}")
+                contacts_dict[str(contact_id)] = contact
+        
+        # Índice por email (en minúsculas) para asociar cada email a su contacto en O(1);
+        # ante emails repetidos se conserva el primer contacto, como antes
+        contacts_by_email = {}
+        for contact in contacts_dict.values():
+            # Asegurar que el email del contacto sea una cadena
+            contacts_by_email.setdefault(str(contact.get('properties.email', '')).lower(), contact)
+        
+        # Obtener todas las empresas de una vez: caché en disco y batch read para las que faltan
+        if 'properties.associatedcompanyid' in contacts_df:
+            companies_dict = get_companies(contacts_df['properties.associatedcompanyid'].dropna().unique())
 
         # Procesar emails
         total_emails = len(emails_df)
@@ -204,98 +278,71 @@ def download_email_contents(emails_csv: str, output_dir: str, force: bool = Fals
         logger.info(f"NOTA: Cada email se guardará inmediatamente después de obtenerlo de la API")
         logger.info(f"NOTA: La información de empresas se cargará desde disco si está disponible")
 
-        for idx, row in emails_df.iterrows():
-            try:
-                # Mostrar progreso más frecuentemente
-                if idx % 10 == 0:
-                    logger.info(f"Processing email {idx + 1} of {total_emails}...")
-                    # Forzar la salida del log
-                    sys.stdout.flush()
-                
-                email_id = row.get('properties.hs_object_id')
-                if not is_valid_id(email_id):
-                    logger.debug(f"Skipping email with invalid ID: {email_id}")
-                    error_emails += 1
-                    continue
-
-                # Obtener el contacto asociado al email
-                # Corregir el error 'float' object has no attribute 'lower'
-                to_email_raw = row.get('properties.hs_email_to_email', '')
-                # Asegurarse de que to_email sea una cadena de texto
-                to_email = str(to_email_raw).lower() if to_email_raw is not None else ''
-                
-                # También asegurar que el email del contacto sea una cadena
-                contact_info = next(
-                    (contact for contact in contacts_dict.values() 
-                     if str(contact.get('properties.email', '')).lower() == to_email),
-                    {'firstname': '', 'lastname': '', 'email': to_email}
-                )
-                
-                # Obtener la empresa asociada al contacto
-                company_id = contact_info.get('properties.associatedcompanyid')
-                company_info = {}
-                if is_valid_id(company_id):
-                    try:
-                        company_id_str = str(company_id)
-                        company_info = companies_dict.get(company_id_str, {})
-                    except Exception as e:
-                        logger.error(f"Error getting company info for ID {company_id}: {e}")
-
-                # Obtener y guardar el contenido del email
+        def iter_email_jobs():
+            """Genera (idx, email_id, contact_info, company_info) para cada email válido."""
+            nonlocal error_emails
+            for idx, row in enumerate(emails_df.to_dict('records')):
                 try:
-                    email_id_str = str(email_id)
-                    logger.info(f"Procesando email {idx + 1}/{total_emails}: ID={email_id_str}")
+                    # Mostrar progreso más frecuentemente
+                    if idx % 10 == 0:
+                        logger.info(f"Processing email {idx + 1} of {total_emails}...")
+                        # Forzar la salida del log
+                        sys.stdout.flush()
                     
-                    # Obtener el contenido del email de la API
-                    email_data = get_email_content(email_id_str)
+                    email_id = normalize_id(row.get('properties.hs_object_id'))
+                    if email_id is None:
+                        logger.debug(f"Skipping email with invalid ID: {row.get('properties.hs_object_id')}")
+                        error_emails += 1
+                        continue
+
+                    # Obtener el contacto asociado al email
+                    # Corregir el error 'float' object has no attribute 'lower'
+                    to_email_raw = row.get('properties.hs_email_to_email', '')
+                    # Asegurarse de que to_email sea una cadena de texto
+                    to_email = str(to_email_raw).lower() if to_email_raw is not None else ''
                     
-                    if email_data:
-                        # Preparar información para el guardado
-                        properties = email_data.get('properties', {})
-                        subject = properties.get('hs_email_subject', 'Sin asunto')
-                        
-                        # Obtener nombres sanitizados para las carpetas
-                        company_name = sanitize_filename(company_info.get('properties', {}).get('name', 'unknown_company'))
-                        to_email_address = properties.get('hs_email_to_email', '')
-                        if not to_email_address:
-                            to_email_address = contact_info.get('email', '')
-                        
-                        # Usar email como nombre de carpeta si está disponible, de lo contrario usar nombre del contacto
-                        if to_email_address and to_email_address.strip():
-                            contact_folder = sanitize_filename(to_email_address)
-                        else:
-                            contact_name = sanitize_filename(f"{contact_info.get('firstname', '')} {contact_info.get('lastname', '')}".strip())
-                            contact_folder = contact_name if contact_name else 'unknown_contact'
-                        
-                        # Generar nombre de archivo
-                        filename = get_email_filename(properties, email_id_str)
-                        email_path = os.path.join(output_dir, company_name, contact_folder, filename)
+                    contact_info = contacts_by_email.get(to_email)
+                    if contact_info is None:
+                        contact_info = {'firstname': '', 'lastname': '', 'email': to_email}
+                    
+                    # Obtener la empresa asociada al contacto; companies_dict ya tiene las
+                    # empresas precargadas, get_company solo va a disco/API si falta alguna
+                    # (y devuelve {} si el ID no es válido)
+                    company_info = get_company(contact_info.get('properties.associatedcompanyid'), cache=companies_dict)
+
+                    yield idx, email_id, contact_info, company_info
+                except Exception as e:
+                    logger.error(f"Error procesando email {idx + 1}: {e}")
+                    error_emails += 1
+
+        def save_result(email_data, idx, email_id_str, contact_info, company_info):
+            """Guarda un email descargado para una de sus filas (se ejecuta en el hilo principal)."""
+            nonlocal processed_emails, skipped_emails, error_emails, completed_emails
+            try:
+                if email_data:
+                    # Guardar inmediatamente el email en disco (save_email_content calcula la ruta)
+                    if save_email_content(email_data, contact_info, company_info, output_dir, force, summarize,
+                                          summary_executor=summary_executor,
+                                          submitted_summaries=submitted_summaries):
+                        processed_emails += 1
+                        logger.info(f"Email {email_id_str} guardado correctamente ({processed_emails} emails guardados hasta ahora)")
                         
-                        # Guardar inmediatamente el email en disco
-                        logger.info(f"Guardando email {email_id_str} en disco: {os.path.abspath(email_path)}")
-                        if save_email_content(email_data, contact_info, company_info, output_dir, force, summarize):
-                            processed_emails += 1
-                            logger.info(f"Email {email_id_str} guardado correctamente ({processed_emails} emails guardados hasta ahora)")
-                            
-                            # Forzar la salida del log
-                            sys.stdout.flush()
-                        else:
-                            skipped_emails += 1
-                            logger.info(f"Email {email_id_str} omitido (ya existe o sin contenido)")
+                        # Forzar la salida del log
+                        sys.stdout.flush()
                     else:
-                        error_emails += 1
-                        logger.warning(f"No se pudo obtener contenido para el email {email_id_str}")
-                except Exception as e:
-                    logger.error(f"Error processing email ID {email_id}: {e}")
+                        skipped_emails += 1
+                        logger.info(f"Email {email_id_str} omitido (ya existe o sin contenido)")
+                else:
                     error_emails += 1
+                    logger.warning(f"No se pudo obtener contenido para el email {email_id_str}")
             except Exception as e:
-                logger.error(f"Error procesando email {idx + 1}: {e}")
+                logger.error(f"Error processing email ID {email_id_str}: {e}")
                 error_emails += 1
-                continue
 
             # Mostrar estadísticas parciales cada 20 emails
-            if (idx + 1) % 20 == 0 or (idx + 1) == total_emails:
-                logger.info(f"=== ESTADÍSTICAS PARCIALES ({idx + 1}/{total_emails}) ===")
+            completed_emails += 1
+            if completed_emails % 20 == 0:
+                logger.info(f"=== ESTADÍSTICAS PARCIALES ({completed_emails}/{total_emails}) ===")
                 logger.info(f"- Nuevos emails guardados: {processed_emails}")
                 logger.info(f"- Emails omitidos: {skipped_emails}")
                 logger.info(f"- Emails con errores: {error_emails}")
@@ -305,6 +352,45 @@ def download_email_contents(emails_csv: str, output_dir: str, force: bool = Fals
                 # Forzar la salida del log
                 sys.stdout.flush()
 
+        def save_results(future, jobs):
+            """Guarda el email de un worker en todas las filas que lo referencian."""
+            try:
+                email_data = future.result()
+            except Exception as e:
+                logger.error(f"Error processing email ID {jobs[0][1]}: {e}")
+                email_data = None
+            for job in jobs:
+                save_result(email_data, *job)
+
+        # Agrupar las filas por ID de email: un mismo email puede aparecer varias veces
+        # en el CSV (p. ej. con varios destinatarios) y solo hace falta descargarlo una vez
+        rows_by_email_id = {}
+        for job in iter_email_jobs():
+            rows_by_email_id.setdefault(job[1], []).append(job)
+        logger.info(f"{len(rows_by_email_id)} emails únicos a descargar")
+
+        # Los workers solo descargan; el guardado en disco se hace en el hilo principal.
+        # Se limita el número de peticiones en vuelo para mantener la memoria acotada.
+        # Los resúmenes, si se piden, se generan en otro pool para no frenar el guardado.
+        completed_emails = 0
+        # Emails ya enviados a resumir, para no resumir dos veces un email repetido en el CSV
+        submitted_summaries = set()
+        max_in_flight = max_workers * 2
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+                (ThreadPoolExecutor(max_workers=summary_concurrency) if summarize else nullcontext()) as summary_executor:
+            in_flight = {}
+            for email_id_str, jobs in rows_by_email_id.items():
+                logger.info(f"Procesando email {jobs[0][0] + 1}/{total_emails}: ID={email_id_str}")
+                in_flight[executor.submit(get_email_content, email_id_str)] = jobs
+                
+                if len(in_flight) >= max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        save_results(future, in_flight.pop(future))
+            
+            for future in as_completed(in_flight):
+                save_results(future, in_flight[future])
+
         logger.info(f"Email download completed:")
         logger.info(f"- Total emails processed: {total_emails}")
         logger.info(f"- New emails downloaded: {processed_emails}")
@@ -2,18 +2,44 @@
 Módulo para resumir emails usando OpenAI.
 """
 
+import asyncio
+import hashlib
 import logging
 import os
+import re
 import json
+import shutil
+import threading
+import time
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Optional, Any
+from typing import Dict, List, Optional, Any, Set, Tuple
 
-from openai import OpenAI
+import orjson
+from openai import OpenAI, AsyncOpenAI
+
+from hubspot.utils import ensure_directory, EMAIL_BODY_SEPARATOR, TokenBucket
 
 logger = logging.getLogger(__name__)
 
-# Prompt para resumir emails
-EMAIL_SUMMARY_PROMPT = """
+# Modelo de OpenAI usado para los resúmenes (se puede cambiar con SUMMARIZER_MODEL)
+SUMMARY_MODEL = os.environ.get("SUMMARIZER_MODEL", "gpt-4o-mini")
+
+# Versión del prompt; incrementarla al cambiar SYSTEM_PROMPT o USER_TEMPLATE
+# para que no se reutilicen resúmenes cacheados con el prompt anterior
+PROMPT_VERSION = 1
+
+# Línea de la cabecera de los emails guardados con el ID de HubSpot
+EMAIL_ID_LINE_RE = re.compile(r'^Email ID: .*(?:\n|$)', re.MULTILINE)
+
+# Directorio de la caché de resúmenes indexada por el hash del contenido del email
+SUMMARY_CACHE_DIR = Path('.cache') / 'summaries'
+
+# Instrucciones para resumir emails. Van en el mensaje de sistema, idéntico en todas
+# las peticiones. Con ~120 tokens queda por debajo del mínimo de 1024 tokens del
+# prompt caching de OpenAI, por lo que el prefijo no se cachea; no se rellena hasta
+# ese mínimo porque eso añadiría tokens a cada petición
+SYSTEM_PROMPT = """
 Eres un asistente especializado en resumir emails de manera detallada y profesional.
 A continuación se presenta un email. Por favor, genera un resumen detallado que incluya:
 
@@ -22,17 +48,99 @@ A continuación se presenta un email. Por favor, genera un resumen detallado que
 3. Cualquier acción requerida o fecha límite mencionada
 4. Tono general del email (formal, informal, urgente, etc.)
 5. Cualquier información importante como números, fechas o datos relevantes
+"""
 
-Email:
+# Mensaje de usuario con el email a resumir
+USER_TEMPLATE = """Email:
 {email_content}
 
 Proporciona un resumen detallado y estructurado.
 """
 
+# USER_TEMPLATE dividido alrededor de su único marcador, para componer el mensaje
+# concatenando cadenas en lugar de llamar a str.format en cada petición
+if USER_TEMPLATE.count('{email_content}') != 1:
+    raise ValueError("USER_TEMPLATE debe contener exactamente un marcador {email_content}")
+USER_PREFIX, USER_SUFFIX = USER_TEMPLATE.split('{email_content}')
+
+# Instrucciones adicionales para resumir varios emails en una sola petición
+MULTI_EMAIL_SYSTEM_PROMPT = SYSTEM_PROMPT + """
+Recibirás varios emails, cada uno precedido de una línea ---ID:<id>---.
+Resume cada email por separado y responde únicamente con un objeto JSON con el formato:
+{"summaries": [{"id": "<id>", "summary": "<resumen>"}, ...]}
+"""
+
+# Número de emails que se resumen en cada petición a OpenAI
+EMAILS_PER_REQUEST = 10
+
+# Longitud máxima (caracteres, ~6000 tokens) que se lee de cada email. El límite real lo
+# impone la ventana de contexto del modelo; leer más solo gasta memoria y tokens
+MAX_PROMPT_CHARS = 24000
+
+# Longitud máxima (caracteres, ~3000 tokens) de cada email en una petición de varios emails
+MAX_EMAIL_CHARS = 12000
+
+# Marca que se añade al final de un email recortado para que el modelo sepa que está incompleto
+TRUNCATED_MARKER = "\n...[truncated]"
+
+# Reintentos de las peticiones a OpenAI ante 429, 5xx, timeouts y errores de conexión
+# (el cliente aplica backoff exponencial con jitter y respeta Retry-After)
+OPENAI_MAX_RETRIES = 6
+
+# Timeout (segundos) de cada petición a OpenAI
+OPENAI_TIMEOUT = 60
+
+# Límites de OpenAI por minuto (peticiones y tokens) que se respetan en el cliente
+OPENAI_RPM = int(os.environ.get("OPENAI_RPM", 500))
+OPENAI_TPM = int(os.environ.get("OPENAI_TPM", 200000))
+
+# Fracción de cada límite por minuto que se puede gastar de golpe; el resto se repone
+# de forma continua, para no superar el límite en ningún minuto
+OPENAI_BURST_FRACTION = 0.1
+
+# Número máximo de peticiones de resumen simultáneas a OpenAI
+SUMMARY_CONCURRENCY = 20
+
+# Número mínimo de emails pendientes para usar la Batch API en lugar de peticiones individuales
+BATCH_MIN_EMAILS = 50
+
+# Límites de la Batch API para cada archivo de entrada (número de peticiones y tamaño)
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_BYTES = 200 * 1024 * 1024
+
+# Intervalo inicial y máximo (segundos) entre consultas del estado de un batch
+BATCH_POLL_INTERVAL = 10
+BATCH_POLL_MAX_INTERVAL = 300
+
+# Buckets compartidos por todas las peticiones de resumen del proceso
+REQUEST_BUCKET = TokenBucket(OPENAI_RPM, 60, OPENAI_RPM * OPENAI_BURST_FRACTION)
+TOKEN_BUCKET = TokenBucket(OPENAI_TPM, 60, OPENAI_TPM * OPENAI_BURST_FRACTION)
+
+def reserve_rate_limit(request: Dict[str, Any]) -> float:
+    """
+    Reserva capacidad en los límites de OpenAI para una petición.
+    
+    Los tokens se estiman como un token cada 4 caracteres del prompt más
+    los max_tokens de la respuesta.
+    
+    Args:
+        request: Argumentos de chat.completions.create
+        
+    Returns:
+        Segundos que hay que esperar antes de enviar la petición
+    """
+    prompt_chars = sum(len(message["content"]) for message in request["messages"])
+    estimated_tokens = prompt_chars // 4 + request["max_tokens"]
+    return max(REQUEST_BUCKET.reserve(1), TOKEN_BUCKET.reserve(estimated_tokens))
+
+@lru_cache(maxsize=1)
 def get_openai_client() -> Optional[OpenAI]:
     """
     Crea y devuelve un cliente de OpenAI.
     
+    El cliente se crea una sola vez y se comparte entre hilos, de modo que
+    todas las peticiones reutilizan su pool de conexiones.
+    
     Returns:
         Cliente de OpenAI o None si no se puede crear
     """
@@ -42,11 +150,65 @@ def get_openai_client() -> Optional[OpenAI]:
         return None
     
     try:
-        return OpenAI(api_key=api_key)
+        return OpenAI(api_key=api_key, max_retries=OPENAI_MAX_RETRIES, timeout=OPENAI_TIMEOUT)
     except Exception as e:
         logger.error(f"Error al crear el cliente de OpenAI: {e}")
         return None
 
+def get_async_openai_client() -> Optional[AsyncOpenAI]:
+    """
+    Crea y devuelve un cliente asíncrono de OpenAI.
+    
+    Returns:
+        Cliente asíncrono de OpenAI o None si no se puede crear
+    """
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        logger.error("No se encontró la variable de entorno OPENAI_API_KEY")
+        return None
+    
+    try:
+        return AsyncOpenAI(api_key=api_key, max_retries=OPENAI_MAX_RETRIES, timeout=OPENAI_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Error al crear el cliente asíncrono de OpenAI: {e}")
+        return None
+
+def build_summary_request(email_content: str) -> Dict[str, Any]:
+    """
+    Construye los parámetros de la petición de resumen a OpenAI.
+    
+    Args:
+        email_content: Contenido del email a resumir
+        
+    Returns:
+        Diccionario con los argumentos para chat.completions.create
+    """
+    return {
+        "model": SUMMARY_MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": USER_PREFIX + email_content + USER_SUFFIX}
+        ],
+        "temperature": 0.3,
+        "max_tokens": 500
+    }
+
+def build_summary_data(summary: str) -> Dict[str, Any]:
+    """
+    Construye los datos del resumen que se guardan en disco.
+    
+    Args:
+        summary: Texto del resumen generado por OpenAI
+        
+    Returns:
+        Diccionario con el resumen del email
+    """
+    return {
+        "summary": summary,
+        "model": SUMMARY_MODEL,
+        "timestamp": time.time()
+    }
+
 def summarize_email(email_content: str) -> Optional[Dict[str, Any]]:
     """
     Genera un resumen detallado de un email usando OpenAI.
@@ -62,31 +224,207 @@ def summarize_email(email_content: str) -> Optional[Dict[str, Any]]:
         return None
     
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Eres un asistente especializado en resumir emails."},
-                {"role": "user", "content": EMAIL_SUMMARY_PROMPT.format(email_content=email_content)}
-            ],
-            temperature=0.3,
-            max_tokens=500
-        )
-        
-        summary = response.choices[0].message.content
+        request = build_summary_request(email_content)
+        time.sleep(reserve_rate_limit(request))
+        response = client.chat.completions.create(**request)
+        return build_summary_data(response.choices[0].message.content)
+    except Exception as e:
+        logger.error(f"Error al generar el resumen del email: {e}")
+        return None
+
+def build_multi_summary_request(items: List[Tuple[str, str]]) -> Dict[str, Any]:
+    """
+    Construye los parámetros de una petición que resume varios emails a la vez.
+    
+    Args:
+        items: Lista de tuplas (id, contenido) de los emails a resumir
+        
+    Returns:
+        Diccionario con los argumentos para chat.completions.create
+    """
+    # Cada email se recorta para no exceder la ventana de contexto del modelo
+    emails = "\n\n".join(
+        f"---ID:{email_id}---\n{truncate_email(email_content, MAX_EMAIL_CHARS)}"
+        for email_id, email_content in items
+    )
+    return {
+        "model": SUMMARY_MODEL,
+        "messages": [
+            {"role": "system", "content": MULTI_EMAIL_SYSTEM_PROMPT},
+            {"role": "user", "content": emails}
+        ],
+        "response_format": {"type": "json_object"},
+        "temperature": 0.3,
+        "max_tokens": 500 * len(items)
+    }
+
+async def summarize_emails_batch_async(client: AsyncOpenAI, items: List[Tuple[str, str]]) -> Dict[str, str]:
+    """
+    Resume varios emails en una sola petición a OpenAI.
+    
+    Args:
+        client: Cliente asíncrono de OpenAI
+        items: Lista de tuplas (id, contenido) de los emails a resumir
         
+    Returns:
+        Diccionario id -> resumen; los emails sin resumen en la respuesta no aparecen
+    """
+    try:
+        request = build_multi_summary_request(items)
+        await asyncio.sleep(reserve_rate_limit(request))
+        response = await client.chat.completions.create(**request)
+        data = json.loads(response.choices[0].message.content)
         return {
-            "summary": summary,
-            "model": "gpt-3.5-turbo",
-            "timestamp": os.path.getmtime(Path(__file__))
+            str(item.get("id")): item["summary"]
+            for item in data.get("summaries", [])
+            if item.get("summary")
         }
     except Exception as e:
-        logger.error(f"Error al generar el resumen del email: {e}")
-        return None
+        logger.error(f"Error al generar el resumen de {len(items)} emails: {e}")
+        return {}
+
+def truncate_email(email_content: str, max_chars: int) -> str:
+    """
+    Recorta un email a max_chars caracteres y añade TRUNCATED_MARKER si se ha recortado.
+    
+    Un email que ya termina en la marca (recortado al leerlo) se recorta
+    de nuevo conservándola, sin duplicarla.
+    
+    Args:
+        email_content: Contenido del email
+        max_chars: Longitud máxima, sin contar la marca
+        
+    Returns:
+        Contenido del email, con la marca al final si estaba o se ha recortado
+    """
+    if email_content.endswith(TRUNCATED_MARKER):
+        email_content = email_content[:-len(TRUNCATED_MARKER)]
+    elif len(email_content) <= max_chars:
+        return email_content
+    return email_content[:max_chars] + TRUNCATED_MARKER
+
+def remove_email_id(email_content: str) -> str:
+    """
+    Quita la línea "Email ID:" de la cabecera de un email guardado.
+    
+    El ID de HubSpot no aporta nada al resumen y es lo único que distingue a
+    dos emails con la misma cabecera y el mismo cuerpo; sin él, ambos comparten
+    prompt y, por tanto, resumen cacheado.
+    
+    Args:
+        email_content: Contenido del email
+        
+    Returns:
+        Contenido del email sin la línea del ID (el cuerpo no se modifica)
+    """
+    header, separator, body = email_content.partition(EMAIL_BODY_SEPARATOR)
+    return EMAIL_ID_LINE_RE.sub('', header) + separator + body
+
+def read_email_content(email_path: Path) -> str:
+    """
+    Lee el contenido de un email, como máximo MAX_PROMPT_CHARS caracteres.
+    
+    Es el texto que se envía al modelo: la cabecera sin el ID de HubSpot y el cuerpo.
+    
+    Args:
+        email_path: Ruta al archivo de email
+        
+    Returns:
+        Contenido del email, marcado como truncado si superaba el límite
+    """
+    with open(email_path, 'r', encoding='utf-8') as f:
+        # Un carácter de más basta para saber si el email supera el límite
+        email_content = f.read(MAX_PROMPT_CHARS + 1)
+    return remove_email_id(truncate_email(email_content, MAX_PROMPT_CHARS))
+
+def get_summary_cache_path(email_content: str, system_prompt: str = SYSTEM_PROMPT) -> Path:
+    """
+    Obtiene la ruta en la caché del resumen de un contenido de email.
+    
+    La clave se calcula con todo lo que ve el modelo (el contenido devuelto por
+    read_email_content, ya sin el ID de HubSpot, y el prompt de sistema), el modelo
+    y la versión del prompt, de modo que cambiar cualquiera de ellos invalida los
+    resúmenes cacheados.
+    
+    Args:
+        email_content: Contenido del email, tal como se envía al modelo
+        system_prompt: Prompt de sistema con el que se resume (SYSTEM_PROMPT o
+            MULTI_EMAIL_SYSTEM_PROMPT)
+        
+    Returns:
+        Ruta del resumen cacheado
+    """
+    key = hashlib.sha256(
+        f"{SUMMARY_MODEL}|{PROMPT_VERSION}|{system_prompt}|{email_content}".encode('utf-8')
+    ).hexdigest()
+    return SUMMARY_CACHE_DIR / f"{key}.json"
+
+def link_summary(cache_path: Path, summary_path: Path) -> None:
+    """
+    Enlaza un resumen cacheado en la ruta de resumen de un email.
+    
+    Se usa un enlace duro para no duplicar bytes; si no es posible
+    (p. ej. distinto sistema de archivos), se copia el archivo.
+    
+    Args:
+        cache_path: Ruta del resumen en la caché
+        summary_path: Ruta del archivo de resumen del email
+    """
+    try:
+        os.link(cache_path, summary_path)
+    except OSError:
+        shutil.copyfile(cache_path, summary_path)
+
+def load_cached_summary(email_content: str, summary_path: Path,
+                        system_prompt: str = SYSTEM_PROMPT) -> bool:
+    """
+    Reutiliza el resumen cacheado de un email con el mismo contenido, si existe.
+    
+    Args:
+        email_content: Contenido del email
+        summary_path: Ruta del archivo de resumen del email
+        system_prompt: Prompt de sistema con el que se resume el email
+        
+    Returns:
+        True si se encontró en la caché y se guardó el resumen, False en caso contrario
+    """
+    cache_path = get_summary_cache_path(email_content, system_prompt)
+    if not cache_path.exists():
+        return False
+    
+    link_summary(cache_path, summary_path)
+    logger.debug("Resumen reutilizado de la caché para %s", summary_path.name)
+    return True
+
+def save_summary(summary_path: Path, summary_data: Dict[str, Any], email_content: str,
+                 system_prompt: str = SYSTEM_PROMPT) -> None:
+    """
+    Guarda el resumen de un email en la caché y lo enlaza junto al email.
+    
+    El resumen se escribe en un archivo temporal que luego se renombra, de modo
+    que una interrupción nunca deja un resumen a medio escribir en la caché.
+    
+    Args:
+        summary_path: Ruta del archivo de resumen
+        summary_data: Datos del resumen
+        email_content: Contenido del email resumido
+        system_prompt: Prompt de sistema con el que se resumió el email
+    """
+    cache_path = get_summary_cache_path(email_content, system_prompt)
+    ensure_directory(cache_path.parent)
+    # Nombre temporal único por hilo: dos workers pueden guardar el mismo contenido a la vez
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    tmp_path.write_bytes(orjson.dumps(summary_data, option=orjson.OPT_INDENT_2))
+    tmp_path.replace(cache_path)
+    
+    link_summary(cache_path, summary_path)
 
 def process_email_file(email_path: Path) -> bool:
     """
     Procesa un archivo de email para generar y guardar su resumen.
     
+    El llamador es quien comprueba que el email no tenga ya un resumen.
+    
     Args:
         email_path: Ruta al archivo de email
         
@@ -94,15 +432,14 @@ def process_email_file(email_path: Path) -> bool:
         True si se procesó correctamente, False en caso contrario
     """
     try:
-        # Verificar si ya existe un resumen
         summary_path = email_path.with_suffix('.summary.json')
-        if summary_path.exists():
-            logger.debug(f"El resumen ya existe para {email_path.name}, omitiendo...")
-            return False
         
         # Leer el contenido del email
-        with open(email_path, 'r', encoding='utf-8') as f:
-            email_content = f.read()
+        email_content = read_email_content(email_path)
+        
+        # Reutilizar el resumen de un email con el mismo contenido
+        if load_cached_summary(email_content, summary_path):
+            return True
         
         # Generar el resumen
         summary_data = summarize_email(email_content)
@@ -111,22 +448,300 @@ def process_email_file(email_path: Path) -> bool:
             return False
         
         # Guardar el resumen
-        with open(summary_path, 'w', encoding='utf-8') as f:
-            json.dump(summary_data, f, ensure_ascii=False, indent=2)
+        save_summary(summary_path, summary_data, email_content)
         
-        logger.debug(f"Resumen guardado para {email_path.name}")
+        logger.debug("Resumen guardado para %s", email_path.name)
         return True
     
     except Exception as e:
         logger.error(f"Error al procesar el email {email_path.name}: {e}")
         return False
 
-def process_emails_in_directory(directory: str) -> Dict[str, int]:
+async def process_email_chunk_async(email_paths: List[Path], client: AsyncOpenAI,
+                                    semaphore: asyncio.Semaphore) -> List[bool]:
+    """
+    Resume un grupo de emails con una sola petición a OpenAI.
+    
+    La lectura y escritura en disco se hacen en un hilo aparte y el semáforo
+    limita cuántas peticiones a OpenAI hay en curso a la vez.
+    
+    Args:
+        email_paths: Rutas de los archivos de email (sin resumen)
+        client: Cliente asíncrono de OpenAI
+        semaphore: Semáforo que limita la concurrencia
+        
+    Returns:
+        Lista indicando para cada email si se guardó su resumen
+    """
+    results = [False] * len(email_paths)
+    
+    async with semaphore:
+        # Leer los emails; los que tienen el mismo contenido que uno ya resumido
+        # (en esta ejecución o en una anterior) se sirven desde la caché
+        items = []
+        for i, email_path in enumerate(email_paths):
+            try:
+                email_content = await asyncio.to_thread(read_email_content, email_path)
+                if await asyncio.to_thread(load_cached_summary, email_content,
+                                           email_path.with_suffix('.summary.json'),
+                                           MULTI_EMAIL_SYSTEM_PROMPT):
+                    results[i] = True
+                else:
+                    items.append((i, email_content))
+            except Exception as e:
+                logger.error(f"Error al procesar el email {email_path.name}: {e}")
+        
+        if not items:
+            return results
+        
+        summaries = await summarize_emails_batch_async(client, [(str(i), content) for i, content in items])
+    
+    # Los resúmenes se guardan fuera del semáforo: así la siguiente petición a OpenAI
+    # puede empezar mientras se escriben en disco
+    async def write_summary(i: int, email_content: str) -> None:
+        email_path = email_paths[i]
+        summary = summaries.get(str(i))
+        if not summary:
+            logger.error(f"No se pudo generar el resumen para {email_path.name}")
+            return
+        
+        try:
+            await asyncio.to_thread(save_summary, email_path.with_suffix('.summary.json'),
+                                    build_summary_data(summary), email_content,
+                                    MULTI_EMAIL_SYSTEM_PROMPT)
+            logger.debug("Resumen guardado para %s", email_path.name)
+            results[i] = True
+        except Exception as e:
+            logger.error(f"Error al procesar el email {email_path.name}: {e}")
+    
+    await asyncio.gather(*[write_summary(i, email_content) for i, email_content in items])
+    return results
+
+async def process_email_files_async(email_files: List[Path], concurrency: int) -> List[bool]:
+    """
+    Resume en paralelo una lista de emails, en grupos de EMAILS_PER_REQUEST por petición.
+    
+    Args:
+        email_files: Rutas de los archivos de email
+        concurrency: Número máximo de peticiones simultáneas a OpenAI
+        
+    Returns:
+        Lista indicando para cada email si se guardó su resumen
+    """
+    client = get_async_openai_client()
+    if not client:
+        return [False] * len(email_files)
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    try:
+        chunk_results = await asyncio.gather(*[
+            process_email_chunk_async(email_files[start:start + EMAILS_PER_REQUEST], client, semaphore)
+            for start in range(0, len(email_files), EMAILS_PER_REQUEST)
+        ])
+        return [result for results in chunk_results for result in results]
+    finally:
+        await client.close()
+
+def wait_for_batch(client: OpenAI, batch_id: str):
+    """
+    Espera a que un batch de OpenAI termine, consultando su estado con backoff exponencial.
+    
+    Args:
+        client: Cliente de OpenAI
+        batch_id: ID del batch
+        
+    Returns:
+        El batch en su estado final
+    """
+    interval = BATCH_POLL_INTERVAL
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in ('completed', 'failed', 'expired', 'cancelled'):
+            return batch
+        
+        logger.info(f"Batch {batch_id} en estado '{batch.status}', esperando {interval}s...")
+        time.sleep(interval)
+        interval = min(interval * 2, BATCH_POLL_MAX_INTERVAL)
+
+def split_batch_lines(lines: List[bytes]) -> List[List[bytes]]:
+    """
+    Reparte las líneas de entrada en grupos que respetan los límites de la Batch API.
+    
+    Args:
+        lines: Líneas JSONL, una petición por línea
+        
+    Returns:
+        Grupos de líneas con como máximo BATCH_MAX_REQUESTS peticiones y
+        BATCH_MAX_BYTES bytes (contando los saltos de línea) cada uno
+    """
+    groups = []
+    current = []
+    current_bytes = 0
+    for line in lines:
+        line_bytes = len(line) + 1
+        if current and (len(current) >= BATCH_MAX_REQUESTS or current_bytes + line_bytes > BATCH_MAX_BYTES):
+            groups.append(current)
+            current = []
+            current_bytes = 0
+        current.append(line)
+        current_bytes += line_bytes
+    if current:
+        groups.append(current)
+    return groups
+
+def create_batch(client: OpenAI, lines: List[bytes]):
+    """
+    Sube un archivo de entrada y crea un batch con sus peticiones.
+    
+    Args:
+        client: Cliente de OpenAI
+        lines: Líneas JSONL del archivo de entrada
+        
+    Returns:
+        El batch creado
+    """
+    batch_input = client.files.create(
+        file=("batch_input.jsonl", b"\n".join(lines)),
+        purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=batch_input.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    logger.info(f"Batch {batch.id} creado con {len(lines)} emails")
+    return batch
+
+def save_batch_output(client: OpenAI, batch, email_paths: List[Path], email_contents: Dict[int, str],
+                      results: List[bool]) -> None:
+    """
+    Guarda el resumen de cada respuesta correcta de un batch terminado.
+    
+    Args:
+        client: Cliente de OpenAI
+        batch: Batch en su estado final
+        email_paths: Rutas de los archivos de email; el custom_id es la posición en esta lista
+        email_contents: Contenido de cada email enviado, por posición
+        results: Lista de resultados que se actualiza con los emails guardados
+    """
+    if batch.status != 'completed' or not batch.output_file_id:
+        logger.error(f"El batch {batch.id} terminó en estado '{batch.status}'")
+        return
+    
+    # Cada fila se procesa por separado: una fila inválida no debe perder los
+    # resúmenes (ya pagados) del resto del batch
+    output = client.files.content(batch.output_file_id).text
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+            i = int(row["custom_id"])
+            email_path = email_paths[i]
+            response = row.get("response") or {}
+            if row.get("error") or response.get("status_code") != 200:
+                logger.error(f"No se pudo generar el resumen para {email_path.name}: {row.get('error')}")
+                continue
+            
+            summary = response["body"]["choices"][0]["message"]["content"]
+            save_summary(email_path.with_suffix('.summary.json'), build_summary_data(summary), email_contents[i])
+            results[i] = True
+        except Exception as e:
+            logger.error(f"Error al procesar una respuesta del batch {batch.id}: {e} ({line[:200]})")
+
+def submit_batch(email_paths: List[Path]) -> List[bool]:
+    """
+    Resume una lista de emails con la Batch API de OpenAI.
+    
+    Se genera una petición por email y se reparten en tantos batches como
+    hagan falta para respetar los límites de BATCH_MAX_REQUESTS y
+    BATCH_MAX_BYTES por archivo. Se crean todos los batches, para que OpenAI
+    los procese a la vez, y después se espera a cada uno y se guarda el
+    resumen de cada respuesta junto a su email.
+    
+    Args:
+        email_paths: Rutas de los archivos de email (sin resumen)
+        
+    Returns:
+        Lista indicando para cada email si se guardó su resumen
+    """
+    results = [False] * len(email_paths)
+    
+    client = get_openai_client()
+    if not client:
+        return results
+    
+    try:
+        # Una línea por email pendiente; el custom_id es su posición en email_paths
+        lines = []
+        email_contents = {}
+        for i, email_path in enumerate(email_paths):
+            summary_path = email_path.with_suffix('.summary.json')
+            email_content = read_email_content(email_path)
+            if load_cached_summary(email_content, summary_path):
+                results[i] = True
+                continue
+            email_contents[i] = email_content
+            lines.append(orjson.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": build_summary_request(email_content)
+            }))
+    except Exception as e:
+        logger.error(f"Error al preparar el batch de resúmenes: {e}")
+        return results
+    
+    # Un fallo en un batch no impide procesar los demás
+    batches = []
+    for group in split_batch_lines(lines):
+        try:
+            batches.append(create_batch(client, group))
+        except Exception as e:
+            logger.error(f"Error al crear un batch de {len(group)} resúmenes: {e}")
+    
+    for batch in batches:
+        try:
+            save_batch_output(client, wait_for_batch(client, batch.id), email_paths, email_contents, results)
+        except Exception as e:
+            logger.error(f"Error al procesar el batch de resúmenes {batch.id}: {e}")
+    
+    return results
+
+def find_email_files(directory: str) -> Tuple[List[str], Set[str]]:
+    """
+    Recorre un directorio y sus subdirectorios en una sola pasada con os.scandir.
+    
+    Args:
+        directory: Directorio base donde buscar emails
+        
+    Returns:
+        Tupla con las rutas de los emails (.txt) y el conjunto de rutas, sin la
+        extensión, de los emails que ya tienen resumen (.summary.json)
+    """
+    email_files = []
+    summarized = set()
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith('.summary.json'):
+                    summarized.add(entry.path[:-len('.summary.json')])
+                elif entry.name.endswith('.txt'):
+                    email_files.append(entry.path)
+    return email_files, summarized
+
+def process_emails_in_directory(directory: str, concurrency: int = SUMMARY_CONCURRENCY,
+                                use_batch: bool = False) -> Dict[str, int]:
     """
     Procesa todos los emails en un directorio y sus subdirectorios.
     
     Args:
         directory: Directorio base donde buscar emails
+        concurrency: Número máximo de peticiones simultáneas a OpenAI
+        use_batch: Si es True y hay suficientes emails, usar la Batch API de OpenAI
         
     Returns:
         Diccionario con estadísticas del procesamiento
@@ -144,24 +759,23 @@ def process_emails_in_directory(directory: str) -> Dict[str, int]:
             logger.error(f"El directorio {directory} no existe o no es un directorio")
             return stats
         
-        # Buscar todos los archivos .txt (emails)
-        email_files = list(base_dir.glob('**/*.txt'))
+        # Buscar todos los archivos .txt (emails) y descartar los que ya tienen resumen
+        email_files, summarized = find_email_files(directory)
+        pending = [Path(path) for path in email_files if path[:-len('.txt')] not in summarized]
         stats["total"] = len(email_files)
+        stats["skipped"] = len(email_files) - len(pending)
         
-        logger.info(f"Procesando {stats['total']} emails para resumir...")
+        logger.info(f"Procesando {len(pending)} emails para resumir ({stats['skipped']} ya resumidos)...")
         
-        for i, email_path in enumerate(email_files):
-            if i % 10 == 0:
-                logger.info(f"Procesando email {i+1} de {stats['total']}...")
-            
-            if process_email_file(email_path):
-                stats["processed"] += 1
-            else:
-                # Verificar si ya existe un resumen
-                if email_path.with_suffix('.summary.json').exists():
-                    stats["skipped"] += 1
-                else:
-                    stats["errors"] += 1
+        if use_batch and len(pending) >= BATCH_MIN_EMAILS:
+            results = submit_batch(pending)
+        else:
+            results = asyncio.run(process_email_files_async(pending, concurrency))
+        
+        # Los resultados son booleanos: se cuentan de una vez en lugar de email a email
+        processed = sum(results)
+        stats["processed"] = processed
+        stats["errors"] = len(results) - processed
         
         logger.info(f"Procesamiento de resúmenes completado:")
         logger.info(f"- Total emails: {stats['total']}")
@@ -3,7 +3,10 @@ Funciones de utilidad para el procesamiento de datos de HubSpot.
 """
 
 import re
+import time
 import logging
+import threading
+from functools import lru_cache
 from pathlib import Path
 from typing import Dict, Any, Optional
 from datetime import datetime
@@ -16,6 +19,50 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class TokenBucket:
+    """Token bucket con reloj monotónico compartido entre hilos y corrutinas.
+    
+    La capacidad es la ráfaga permitida y se repone limit - burst por ventana,
+    de modo que ninguna ventana de window segundos concede más de limit tokens.
+    
+    reserve() descuenta los tokens pedidos aunque el saldo quede negativo y
+    devuelve cuánto hay que esperar hasta que se repongan; la espera la hace
+    el llamador, fuera del lock (time.sleep o asyncio.sleep).
+    """
+    
+    def __init__(self, limit: float, window: float, burst: float):
+        """
+        Args:
+            limit: Tokens permitidos en cada ventana
+            window: Duración de la ventana en segundos
+            burst: Tokens que se pueden gastar de golpe (menor que limit)
+        """
+        self.capacity = float(burst)
+        self.refill_rate = (limit - burst) / window
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def reserve(self, amount: float = 1) -> float:
+        """
+        Reserva tokens del bucket.
+        
+        Args:
+            amount: Número de tokens a reservar
+            
+        Returns:
+            Segundos que hay que esperar antes de usar los tokens reservados
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+            self.last_refill = now
+            self.tokens -= amount
+            return -self.tokens / self.refill_rate if self.tokens < 0 else 0.0
+
+# Tabla de traducción que reemplaza los caracteres no válidos en nombres de archivo por '_'
+SANITIZE_TABLE = str.maketrans({c: '_' for c in '<>:"/\\|?*\''})
+
 def sanitize_filename(filename: Optional[str]) -> str:
     """Sanitiza un nombre de archivo para que sea válido en el sistema de archivos.
     
@@ -29,13 +76,29 @@ def sanitize_filename(filename: Optional[str]) -> str:
     if filename is None:
         return 'unknown'
         
-    # Reemplazar caracteres no válidos con guion bajo
-    filename = re.sub(r'[<>:"/\\|?*\']', '_', filename)
-    # Eliminar espacios al inicio y final
-    filename = filename.strip()
+    # Reemplazar caracteres no válidos con guion bajo y eliminar espacios al inicio y final
+    filename = filename.translate(SANITIZE_TABLE).strip()
     # Si está vacío, usar 'unknown'
     return filename if filename else 'unknown'
 
+# Prefijo de una fecha ISO 8601 (YYYY-MM-DD[T ]HH:MM:SS) que puede parsear datetime.fromisoformat
+ISO_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}')
+
+def format_timestamp_for_filename(timestamp) -> str:
+    """Formatea un timestamp (en segundos o milisegundos) para un nombre de archivo.
+    
+    Args:
+        timestamp: Timestamp numérico
+        
+    Returns:
+        Cadena de fecha formateada para nombre de archivo (YYYYMMDD_HHMMSS)
+    """
+    timestamp = int(timestamp)
+    # Si el timestamp es muy grande (ms), convertir a segundos
+    if timestamp > 1000000000000:  # Probablemente en milisegundos
+        timestamp = timestamp / 1000
+    return datetime.fromtimestamp(timestamp).strftime('%Y%m%d_%H%M%S')
+
 def parse_date_for_filename(date_value):
     """Parsea una fecha desde diferentes formatos para usarla en un nombre de archivo.
     
@@ -49,25 +112,35 @@ def parse_date_for_filename(date_value):
         if date_value is None:
             return "unknown_date"
         
+        # Camino rápido: timestamp numérico sin pasar por cadenas
+        if isinstance(date_value, (int, float)):
+            try:
+                return format_timestamp_for_filename(date_value)
+            except (ValueError, OverflowError, OSError) as e:
+                logger.debug("Error parsing timestamp: %s", e)
+                return "unknown_date"
+        
         # Si es un string que parece una fecha ISO
         if isinstance(date_value, str) and ('T' in date_value or '-' in date_value):
+            # Camino rápido: fromisoformat (implementado en C) para ISO 8601 estándar
+            if ISO_DATE_RE.match(date_value):
+                try:
+                    return datetime.fromisoformat(date_value.replace('Z', '+00:00')).strftime('%Y%m%d_%H%M%S')
+                except ValueError:
+                    pass
+            
             try:
                 # Intentar parsear como fecha ISO
                 dt = dateutil.parser.parse(date_value)
                 return dt.strftime('%Y%m%d_%H%M%S')
             except Exception as e:
-                logger.debug(f"Error parsing ISO date: {e}")
+                logger.debug("Error parsing ISO date: %s", e)
         
         # Si es un número (timestamp en ms)
         try:
-            # Convertir a entero y dividir por 1000 si es necesario
-            timestamp = int(float(date_value))
-            # Si el timestamp es muy grande (ms), convertir a segundos
-            if timestamp > 1000000000000:  # Probablemente en milisegundos
-                timestamp = timestamp / 1000
-            return datetime.fromtimestamp(timestamp).strftime('%Y%m%d_%H%M%S')
+            return format_timestamp_for_filename(float(date_value))
         except Exception as e:
-            logger.debug(f"Error parsing timestamp: {e}")
+            logger.debug("Error parsing timestamp: %s", e)
         
         # Si todo falla, devolver un valor por defecto
         return "unknown_date"
@@ -75,6 +148,9 @@ def parse_date_for_filename(date_value):
         logger.error(f"Error formatting date {date_value}: {e}")
         return "unknown_date"
 
+# Separador entre la cabecera (Subject, From, To...) y el cuerpo de los emails guardados
+EMAIL_BODY_SEPARATOR = f"\n{'=' * 50}\n\n"
+
 def get_email_filename(properties: Dict[str, Any], email_id: str) -> str:
     """Generar nombre de archivo para el email.
     
@@ -88,9 +164,16 @@ def get_email_filename(properties: Dict[str, Any], email_id: str) -> str:
     # Usar directamente el ID de HubSpot como nombre de archivo
     return f"{email_id}.txt"
 
+# Número de directorios ya creados que se recuerdan (evita repetir mkdir en cada email)
+DIRECTORY_CACHE_SIZE = 1024
+
+@lru_cache(maxsize=DIRECTORY_CACHE_SIZE)
 def ensure_directory(path: str) -> Path:
     """Asegura que un directorio exista, creándolo si es necesario.
     
+    Cada directorio solo se crea una vez por proceso; las llamadas siguientes
+    no hacen ninguna llamada al sistema.
+    
     Args:
         path: Ruta del directorio
         
@@ -9,11 +9,12 @@ respetando los límites de la API (110 peticiones cada 10 segundos).
 import logging
 import argparse
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from hubspot.api import get_contacts, get_engagements
 from hubspot.models import save_to_csv
-from hubspot.email_processor import download_email_contents
-from hubspot.summarizer import process_emails_in_directory
+from hubspot.email_processor import download_email_contents, MAX_WORKERS
+from hubspot.summarizer import process_emails_in_directory, SUMMARY_CONCURRENCY
 
 # Configuración de logging
 logging.basicConfig(
@@ -43,13 +44,26 @@ def parse_args():
                       help='Omitir la descarga de engagements')
     parser.add_argument('--skip-emails', action='store_true',
                       help='Omitir la descarga de contenido de emails')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS,
+                      help=f'Número de emails a descargar en paralelo (default: {MAX_WORKERS})')
     parser.add_argument('--summarize', action='store_true',
                       help='Generar resúmenes de emails usando OpenAI')
     parser.add_argument('--only-summarize', action='store_true',
                       help='Solo procesar emails existentes para generar resúmenes (no descargar nuevos)')
+    parser.add_argument('--summarize-concurrency', type=int, default=SUMMARY_CONCURRENCY,
+                      help=f'Número de resúmenes a generar en paralelo (default: {SUMMARY_CONCURRENCY})')
+    parser.add_argument('--batch-summarize', action='store_true',
+                      help='Usar la Batch API de OpenAI para los resúmenes (más barata, pero asíncrona; '
+                           'requiere --only-summarize)')
     parser.add_argument('--verbose', '-v', action='store_true',
                       help='Mostrar información detallada durante la ejecución')
-    return parser.parse_args()
+    args = parser.parse_args()
+    
+    # Durante la descarga los emails se resumen según se guardan; la Batch API
+    # solo tiene sentido al resumir de una vez los emails ya descargados
+    if args.batch_summarize and not args.only_summarize:
+        parser.error('--batch-summarize requiere --only-summarize')
+    return args
 
 def main():
     """Función principal del script.
@@ -73,7 +87,8 @@ def main():
         # Si solo se solicita resumir emails existentes
         if args.only_summarize:
             logger.info("Modo de solo resumen activado, procesando emails existentes...")
-            process_emails_in_directory(args.output_dir)
+            process_emails_in_directory(args.output_dir, concurrency=args.summarize_concurrency,
+                                        use_batch=args.batch_summarize)
             logger.info("Proceso completado con éxito.")
             return
         
@@ -88,17 +103,24 @@ def main():
         # Tipos de engagements disponibles
         engagement_types = ['notes', 'emails', 'calls', 'meetings', 'tasks']
 
-        # Descargar engagements
+        # Descargar engagements en paralelo; el rate limiter de hubspot.api sigue
+        # limitando el total de peticiones a 110 cada 10 segundos
         if not args.skip_engagements:
-            for engagement_type in engagement_types:
-                logger.info(f"Downloading engagements: {engagement_type}...")
-                engagements = get_engagements(engagement_type)
-                save_to_csv(engagements, f'hubspot_{engagement_type}.csv')
+            with ThreadPoolExecutor(max_workers=len(engagement_types)) as executor:
+                futures = {}
+                for engagement_type in engagement_types:
+                    logger.info(f"Downloading engagements: {engagement_type}...")
+                    futures[executor.submit(get_engagements, engagement_type)] = engagement_type
+                
+                for future in as_completed(futures):
+                    engagement_type = futures[future]
+                    save_to_csv(future.result(), f'hubspot_{engagement_type}.csv')
 
         # Descargar contenido completo de emails
         if not args.skip_emails:
             logger.info("Starting detailed email content download...")
-            download_email_contents('hubspot_emails.csv', args.output_dir, args.force, args.summarize)
+            download_email_contents('hubspot_emails.csv', args.output_dir, args.force, args.summarize,
+                                    max_workers=args.workers, summary_concurrency=args.summarize_concurrency)
 
         logger.info("Process completed successfully.")
     except Exception as e:
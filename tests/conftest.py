@@ -6,8 +6,9 @@ import os
 import pytest
 import logging
 
-# Establecer la clave de API para las pruebas
-os.environ['HUBSPOT_API_KEY'] = 'test_api_key_for_tests'
+# Establecer la clave de API para las pruebas. Se hace al importar conftest, antes de que
+# pytest recoja los módulos de prueba (que importan hubspot.api); un fixture llegaría tarde
+os.environ.setdefault('HUBSPOT_API_KEY', 'test_api_key_for_tests')
 
 # Configurar logging para las pruebas
 @pytest.fixture(autouse=True)
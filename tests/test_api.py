@@ -1,33 +1,34 @@
 import unittest
-import os
-import math
-import time
-import sys
+import tempfile
+import requests
 from unittest.mock import patch, MagicMock, call
-from datetime import datetime, timedelta
-from collections import deque
+from diskcache import FanoutCache
 
-# Importar el módulo test_init para asegurar que la variable de entorno esté configurada
-import test_init
+from hubspot.utils import TokenBucket
 
+import hubspot.api as api
 from hubspot.api import (
     is_valid_id, 
+    normalize_id,
     wait_for_rate_limit, 
-    handle_rate_limit, 
     make_api_request,
+    iter_pages,
     get_company,
-    get_email_content
+    get_companies,
+    get_companies_batch,
+    get_email_content,
+    save_company_to_disk,
+    load_company_from_disk,
+    REQUEST_TIMEOUT,
+    RATE_LIMIT,
+    RATE_WINDOW,
+    RATE_BURST,
+    COMPANY_BATCH_SIZE
 )
 
 class TestAPI(unittest.TestCase):
     """Pruebas para las funciones de la API."""
     
-    def setUp(self):
-        """Configuración para las pruebas."""
-        # Asegurar que la variable de entorno esté configurada
-        if 'HUBSPOT_API_KEY' not in os.environ:
-            os.environ['HUBSPOT_API_KEY'] = 'test_api_key'
-    
     def test_is_valid_id(self):
         """Prueba la función is_valid_id."""
         # Casos válidos
@@ -37,87 +38,74 @@ class TestAPI(unittest.TestCase):
                 self.assertTrue(is_valid_id(id_value))
         
         # Casos inválidos
-        invalid_ids = [None, "", "nan", "NaN", float('nan'), " "]
+        invalid_ids = [None, "", "nan", "NaN", float('nan'), float('inf'), " ", "abc"]
         for id_value in invalid_ids:
             with self.subTest(id_value=id_value):
                 self.assertFalse(is_valid_id(id_value))
     
-    @patch('hubspot.api.request_timestamps', new_callable=deque)
+    def test_normalize_id(self):
+        """Prueba la función normalize_id."""
+        # Casos válidos: todos se normalizan a la misma forma
+        for id_value in [123, "123", 123.0, "123.0", " 123 "]:
+            with self.subTest(id_value=id_value):
+                self.assertEqual(normalize_id(id_value), "123")
+        
+        # Casos inválidos
+        invalid_ids = [None, "", "nan", "NaN", float('nan'), float('inf'), " ", "abc"]
+        for id_value in invalid_ids:
+            with self.subTest(id_value=id_value):
+                self.assertIsNone(normalize_id(id_value))
+    
     @patch('hubspot.api.time.sleep')
-    @patch('hubspot.api.datetime')
-    def test_wait_for_rate_limit(self, mock_datetime, mock_sleep, mock_timestamps):
+    @patch('hubspot.utils.time.monotonic', return_value=1000.0)
+    def test_wait_for_rate_limit(self, mock_monotonic, mock_sleep):
         """Prueba la función wait_for_rate_limit."""
-        # Configurar el mock de datetime
-        now = datetime(2025, 3, 22, 16, 0, 0)
-        mock_datetime.now.return_value = now
-        
-        # Caso 1: No hay timestamps previos (lista vacía)
-        wait_for_rate_limit()
-        # Verificar que se agregó el timestamp actual
-        self.assertEqual(len(mock_timestamps), 1)
-        
-        # Restablecer mocks
-        mock_timestamps.clear()
-        mock_sleep.reset_mock()
-        
-        # Caso 2: Hay timestamps pero no se alcanza el límite
-        for i in range(50):  # Agregar 50 timestamps (menos que el límite de 110)
-            mock_timestamps.append(now - timedelta(seconds=i))
-        
-        wait_for_rate_limit()
-        # Verificar que no se llamó a sleep
-        mock_sleep.assert_not_called()
-        # Verificar que ahora hay 51 timestamps
-        self.assertEqual(len(mock_timestamps), 51)
-        
-        # Restablecer mocks
-        mock_timestamps.clear()
-        mock_sleep.reset_mock()
-        
-        # Caso 3: Se alcanza el límite y se necesita esperar
-        # Llenar la cola con el máximo de timestamps (110)
-        for i in range(110):
-            mock_timestamps.append(now - timedelta(seconds=10))  # Todos 10 segundos atrás
-            
-        wait_for_rate_limit()
-        # Debe esperar 0 segundos (ya pasaron 10 segundos desde el timestamp más antiguo)
-        mock_sleep.assert_not_called()
-        
-        # Caso 4: Se alcanza el límite y el timestamp más antiguo es reciente
-        mock_timestamps.clear()
-        mock_sleep.reset_mock()
-        
-        # Llenar la cola con el máximo de timestamps (110)
-        for i in range(110):
-            mock_timestamps.append(now - timedelta(seconds=5))  # Todos 5 segundos atrás
+        with patch.object(api, 'RATE_BUCKET', TokenBucket(RATE_LIMIT, RATE_WINDOW, RATE_BURST)) as bucket:
+            # La ráfaga se concede sin esperar
+            for _ in range(RATE_BURST):
+                wait_for_rate_limit()
+            mock_sleep.assert_not_called()
             
-        wait_for_rate_limit()
-        # Debe esperar 5 segundos
-        mock_sleep.assert_called_once_with(5.0)
+            # Agotada la ráfaga, se espera lo necesario para un token
+            wait_for_rate_limit()
+            mock_sleep.assert_called_once()
+            self.assertAlmostEqual(mock_sleep.call_args[0][0], 1 / bucket.refill_rate)
     
     @patch('hubspot.api.time.sleep')
-    def test_handle_rate_limit(self, mock_sleep):
-        """Prueba la función handle_rate_limit."""
-        # Crear una respuesta simulada con Retry-After
-        mock_response = MagicMock()
-        mock_response.status_code = 429
-        mock_response.headers = {'Retry-After': '5'}
+    @patch('hubspot.utils.time.monotonic')
+    def test_wait_for_rate_limit_window(self, mock_monotonic, mock_sleep):
+        """Ninguna ventana de RATE_WINDOW segundos concede más de RATE_LIMIT peticiones."""
+        grants = []
         
-        handle_rate_limit(mock_response)
-        mock_sleep.assert_called_once_with(5)
+        def request_burst(now, count):
+            """Simula count hilos que piden a la vez; cada uno sale cuando acaba su espera."""
+            mock_monotonic.return_value = now
+            for _ in range(count):
+                mock_sleep.reset_mock()
+                wait_for_rate_limit()
+                grants.append(now + (mock_sleep.call_args[0][0] if mock_sleep.called else 0))
         
-        # Restablecer mock
-        mock_sleep.reset_mock()
+        # Una ráfaga con el bucket lleno y otra tras un rato sin peticiones
+        mock_monotonic.return_value = 1000.0
+        with patch.object(api, 'RATE_BUCKET', TokenBucket(RATE_LIMIT, RATE_WINDOW, RATE_BURST)):
+            request_burst(1000.0, 2 * RATE_LIMIT)
+            request_burst(max(grants) + 3 * RATE_WINDOW, 2 * RATE_LIMIT)
         
-        # Probar sin Retry-After (debe usar el valor predeterminado)
-        mock_response.headers = {}
-        handle_rate_limit(mock_response)
-        mock_sleep.assert_called_once_with(10)
+        grants.sort()
+        busiest = max(
+            sum(1 for other in grants[i:] if other - start < RATE_WINDOW)
+            for i, start in enumerate(grants)
+        )
+        self.assertLessEqual(busiest, RATE_LIMIT)
+        # El límite se aprovecha: no se frena más de lo necesario
+        self.assertGreaterEqual(busiest, RATE_LIMIT - 2)
     
-    @patch('hubspot.api.requests.get')
+    @patch('hubspot.api.get_session')
     @patch('hubspot.api.wait_for_rate_limit')
-    def test_make_api_request(self, mock_wait, mock_get):
+    def test_make_api_request(self, mock_wait, mock_get_session):
         """Prueba la función make_api_request."""
+        mock_get = mock_get_session.return_value.get
+        
         # Configurar una respuesta exitosa
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -127,7 +115,11 @@ class TestAPI(unittest.TestCase):
         # Prueba de solicitud exitosa
         result = make_api_request('https://api.test.com', {'param': 'value'})
         mock_wait.assert_called_once()
-        mock_get.assert_called_once()
+        mock_get.assert_called_once_with(
+            'https://api.test.com',
+            params={'param': 'value'},
+            timeout=REQUEST_TIMEOUT
+        )
         self.assertEqual(result, {'success': True})
         
         # Restablecer mocks
@@ -139,9 +131,60 @@ class TestAPI(unittest.TestCase):
         
         with self.assertRaises(Exception):
             make_api_request('https://api.test.com', {'param': 'value'})
+        
+    @patch('hubspot.api.time.sleep')
+    @patch('hubspot.api.get_session')
+    @patch('hubspot.api.wait_for_rate_limit')
+    def test_make_api_request_retries(self, mock_wait, mock_get_session, mock_sleep):
+        """Los 429 y 5xx se reintentan pasando cada vez por el rate limiter."""
+        mock_get = mock_get_session.return_value.get
+        
+        def error_response(status_code, headers):
+            response = MagicMock()
+            response.status_code = status_code
+            response.headers = headers
+            response.raise_for_status.side_effect = requests.exceptions.HTTPError(response=response)
+            return response
+        
+        ok_response = MagicMock()
+        ok_response.status_code = 200
+        ok_response.json.return_value = {'success': True}
+        
+        # Un 429 con Retry-After: se espera lo indicado y el reintento toma otro token
+        mock_get.side_effect = [error_response(429, {'Retry-After': '5'}), ok_response]
+        self.assertEqual(make_api_request('https://api.test.com', {}), {'success': True})
+        self.assertEqual(mock_wait.call_count, 2)
+        mock_sleep.assert_called_once_with(5.0)
+        
+        mock_wait.reset_mock()
+        mock_sleep.reset_mock()
+        
+        # Un 5xx persistente: backoff exponencial y el error se propaga al agotar los reintentos
+        mock_get.side_effect = [error_response(503, {})] * (api.MAX_RETRIES + 1)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            make_api_request('https://api.test.com', {})
+        self.assertEqual(mock_wait.call_count, api.MAX_RETRIES + 1)
+        self.assertEqual([c[0][0] for c in mock_sleep.call_args_list], [1, 2, 4])
     
     @patch('hubspot.api.make_api_request')
-    def test_get_company(self, mock_make_request):
+    def test_iter_pages(self, mock_make_request):
+        """Prueba la función iter_pages."""
+        mock_make_request.side_effect = [
+            {'results': [{'id': '1'}, {'id': '2'}], 'paging': {'next': {'after': 'abc'}}},
+            {'results': [{'id': '3'}]}
+        ]
+        
+        result = list(iter_pages('https://api.test.com', {'limit': 100}))
+        
+        self.assertEqual([r['id'] for r in result], ['1', '2', '3'])
+        # La segunda página se pide con el cursor de la primera
+        self.assertEqual(mock_make_request.call_args_list[0], call('https://api.test.com', {'limit': 100}))
+        self.assertEqual(mock_make_request.call_args_list[1][0][1], {'limit': 100, 'after': 'abc'})
+    
+    @patch('hubspot.api.save_company_to_disk')
+    @patch('hubspot.api.load_company_from_disk', return_value=None)
+    @patch('hubspot.api.make_api_request')
+    def test_get_company(self, mock_make_request, mock_load, mock_save):
         """Prueba la función get_company."""
         # Configurar respuesta simulada
         mock_make_request.return_value = {
@@ -180,6 +223,73 @@ class TestAPI(unittest.TestCase):
         result = get_company(float('nan'))
         self.assertEqual(result, {})
         mock_make_request.assert_not_called()
+        
+        # Caso 5: Con caché explícita, se consulta primero y se rellena en los fallos
+        mock_make_request.reset_mock()
+        cache = {'7': {'properties': {'name': 'In Memory'}}}
+        self.assertIs(get_company('7.0', cache=cache), cache['7'])
+        mock_make_request.assert_not_called()
+        result = get_company('123', cache=cache)
+        self.assertIs(cache['123'], result)
+        mock_make_request.assert_called_once()
+        
+        # Caso 6: Empresa repetida con la misma caché, se sirve desde memoria sin tocar disco ni API
+        mock_make_request.reset_mock()
+        mock_load.reset_mock()
+        self.assertIs(get_company(123, cache=cache), result)
+        mock_make_request.assert_not_called()
+        mock_load.assert_not_called()
+    
+    @patch('hubspot.api.save_company_to_disk')
+    @patch('hubspot.api.load_company_from_disk')
+    @patch('hubspot.api.make_api_request')
+    def test_get_companies(self, mock_make_request, mock_load, mock_save):
+        """Prueba la función get_companies."""
+        cached = {'id': '1', 'properties': {'name': 'Cached Company'}}
+        mock_load.side_effect = lambda company_id: cached if company_id == '1' else None
+        mock_make_request.return_value = {
+            'results': [{'id': '2', 'properties': {'name': 'API Company'}}]
+        }
+        
+        # IDs repetidos, con formato decimal o inválidos
+        result = get_companies(['1', 2.0, '2', None, float('nan'), 'nan'])
+        
+        self.assertEqual(result['1']['properties']['name'], 'Cached Company')
+        self.assertEqual(result['2']['properties']['name'], 'API Company')
+        # Solo la empresa que no estaba en disco se pide a la API, en una sola petición
+        mock_make_request.assert_called_once_with(
+            'https://api.hubapi.com/crm/v3/objects/companies/batch/read',
+            {},
+            {'properties': ['name', 'domain'], 'inputs': [{'id': '2'}]}
+        )
+        mock_save.assert_called_once_with('2', result['2'])
+        
+        # Más IDs que el tamaño de bloque se reparten en varias peticiones
+        mock_make_request.reset_mock()
+        mock_make_request.return_value = {'results': []}
+        get_companies_batch([str(i) for i in range(COMPANY_BATCH_SIZE + 1)])
+        self.assertEqual(mock_make_request.call_count, 2)
+    
+    def test_get_session(self):
+        """La sesión se crea una sola vez y lleva la cabecera de autorización."""
+        api.get_session.cache_clear()
+        session = api.get_session()
+        self.assertIs(api.get_session(), session)
+        self.assertEqual(session.headers['Authorization'], f"Bearer {api.API_KEY}")
+        # urllib3 no reintenta respuestas: esos reintentos no pasarían por el rate limiter
+        self.assertEqual(session.get_adapter(api.BASE_URL).max_retries.status, 0)
+    
+    def test_company_disk_cache(self):
+        """Prueba save_company_to_disk y load_company_from_disk."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = FanoutCache(temp_dir, shards=2)
+            with patch('hubspot.api.get_company_cache', return_value=cache):
+                self.assertIsNone(load_company_from_disk('123'))
+                
+                company = {'id': '123', 'properties': {'name': 'Compañía', 'domain': 'test.com'}}
+                save_company_to_disk('123', company)
+                self.assertEqual(load_company_from_disk('123'), company)
+            cache.close()
     
     @patch('hubspot.api.make_api_request')
     def test_get_email_content(self, mock_make_request):
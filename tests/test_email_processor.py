@@ -1,170 +1,311 @@
+import io
 import unittest
-import os
 import tempfile
 import pandas as pd
+import pytest
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from unittest.mock import patch, MagicMock, mock_open
+from types import MappingProxyType, SimpleNamespace
+from datetime import datetime
+from unittest.mock import patch, DEFAULT
 
-# Importar el módulo test_init para asegurar que la variable de entorno esté configurada
-import test_init
+from hubspot.email_processor import (
+    format_date, save_email_content, download_email_contents, get_email_directory, summarize_saved_email
+)
 
-from hubspot.email_processor import save_email_content, download_email_contents
+class FakeOpen:
+    """Sustituto ligero de open() que guarda lo escrito en un StringIO, sin registrar llamadas."""
+    
+    def __init__(self):
+        self.buf = io.StringIO()
+    
+    def __enter__(self):
+        return self.buf
+    
+    def __exit__(self, *args):
+        return False
+
+# Datos de prueba para save_email_content (de solo lectura; las variantes se crean con dict(...))
+EMAIL_DATA = MappingProxyType({
+    'id': '12345',
+    'properties': MappingProxyType({
+        'hs_email_subject': 'Test Subject',
+        'hs_email_text': 'This is a test email content.',
+        'hs_timestamp': '1616432400000',  # 2021-03-22 15:00:00
+        'hs_email_status': 'SENT',
+        'hs_email_to_email': 'test@example.com',
+        'hs_email_from_email': 'sender@example.com'
+    })
+})
+
+CONTACT_INFO = MappingProxyType({
+    'firstname': 'John',
+    'lastname': 'Doe',
+    'email': 'test@example.com'
+})
+
+COMPANY_INFO = MappingProxyType({
+    'properties': MappingProxyType({
+        'name': 'Test Company',
+        'domain': 'testcompany.com'
+    })
+})
+
+# DataFrames de prueba para download_email_contents; se crean una sola vez porque
+# read_csv está mockeado y la función no los modifica
+EMAILS_DF = pd.DataFrame({
+    'id': ['1', '2', '3', '4'],
+    'properties.hs_object_id': ['101', '102', float('nan'), '102'],
+    'properties.hs_email_to_email': ['contact1@example.com', 'contact2@example.com', 'contact3@example.com',
+                                     'contact2@example.com']
+})
+
+CONTACTS_DF = pd.DataFrame({
+    'id': ['201', '202'],
+    'properties.email': ['contact1@example.com', 'contact2@example.com'],
+    'properties.associatedcompanyid': ['301', '302'],
+    'firstname': ['John', 'Jane'],
+    'lastname': ['Doe', 'Smith']
+})
+
+# Respuestas de get_email_content para download_email_contents
+EMAIL_RESPONSES = {
+    '101': {
+        'id': '101',
+        'properties': {
+            'hs_email_subject': 'Email 1',
+            'hs_email_text': 'Content 1',
+            'hs_timestamp': '1616432400000'
+        }
+    },
+    '102': {
+        'id': '102',
+        'properties': {
+            'hs_email_subject': 'Email 2',
+            'hs_email_text': 'Content 2',
+            'hs_timestamp': '1616518800000'
+        }
+    }
+}
+
+class FakeGetEmailContent:
+    """Sustituto de get_email_content que responde con EMAIL_RESPONSES y anota los IDs pedidos."""
+    
+    def __init__(self):
+        self.requested = []
+    
+    def __call__(self, email_id):
+        self.requested.append(email_id)
+        return EMAIL_RESPONSES.get(email_id, {})
 
 class TestEmailProcessor(unittest.TestCase):
     """Pruebas para las funciones de procesamiento de emails."""
     
-    def setUp(self):
-        """Configuración para las pruebas."""
-        # Asegurar que la variable de entorno esté configurada
-        if 'HUBSPOT_API_KEY' not in os.environ:
-            os.environ['HUBSPOT_API_KEY'] = 'test_api_key'
-    
-    def test_save_email_content(self):
-        """Prueba la función save_email_content."""
-        # Crear datos de prueba
-        email_data = {
-            'id': '12345',
-            'properties': {
-                'hs_email_subject': 'Test Subject',
-                'hs_email_text': 'This is a test email content.',
-                'hs_timestamp': '1616432400000',  # 2021-03-22 15:00:00
-                'hs_email_status': 'SENT',
-                'hs_email_to_email': 'test@example.com',
-                'hs_email_from_email': 'sender@example.com'
-            }
-        }
-        
-        contact_info = {
-            'firstname': 'John',
-            'lastname': 'Doe',
-            'email': 'test@example.com'
-        }
+    def test_format_date(self):
+        """Prueba la función format_date."""
+        expected = datetime.fromtimestamp(1616432400).strftime('%Y-%m-%d %H:%M:%S')
         
-        company_info = {
-            'properties': {
-                'name': 'Test Company',
-                'domain': 'testcompany.com'
-            }
-        }
-        
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Prueba de guardado exitoso
-            with patch('builtins.open', mock_open()) as mock_file:
-                result = save_email_content(email_data, contact_info, company_info, temp_dir)
-                self.assertTrue(result)
-                mock_file.assert_called_once()
-                
-                # Verificar que se escribió el contenido correcto
-                handle = mock_file()
-                self.assertTrue(handle.write.call_count >= 6)  # Al menos 6 líneas escritas
-                
-                # Verificar que se llamó con los argumentos correctos
-                # En lugar de verificar la ruta exacta, verificamos que contenga partes clave
-                file_path = mock_file.call_args[0][0]
-                self.assertIn('Test Company', file_path)
-                self.assertIn('John Doe', file_path)
-                self.assertIn('Test Subject', file_path)
-                self.assertIn('12345.txt', file_path)
-            
-            # Prueba con email sin contenido
-            email_data_no_text = {
-                'id': '12345',
-                'properties': {
-                    'hs_email_subject': 'Test Subject',
-                    'hs_timestamp': '1616432400000'
-                }
-            }
-            
-            result = save_email_content(email_data_no_text, contact_info, company_info, temp_dir)
-            self.assertFalse(result)
-            
-            # Prueba con error
-            with patch('builtins.open', side_effect=Exception("Test error")):
-                result = save_email_content(email_data, contact_info, company_info, temp_dir)
-                self.assertFalse(result)
-    
-    @patch('hubspot.email_processor.get_email_content')
-    @patch('hubspot.email_processor.get_company')
-    @patch('hubspot.email_processor.save_email_content')
-    @patch('hubspot.email_processor.pd.read_csv')
-    @patch('hubspot.email_processor.ensure_directory')
-    @patch('hubspot.email_processor.is_valid_id')
-    def test_download_email_contents(self, mock_is_valid_id, mock_ensure_dir, mock_read_csv, 
-                                   mock_save, mock_get_company, mock_get_email):
-        """Prueba la función download_email_contents."""
-        # Configurar mocks
-        mock_ensure_dir.return_value = Path('/tmp/test')
-        mock_is_valid_id.side_effect = lambda x: x not in [None, float('nan'), 'nan', '']
+        # Timestamps en ms (string o número) y en segundos
+        self.assertEqual(format_date('1616432400000'), expected)
+        self.assertEqual(format_date(1616432400000), expected)
+        self.assertEqual(format_date(1616432400), expected)
         
-        # Crear DataFrames de prueba
-        emails_df = pd.DataFrame({
-            'id': ['1', '2', '3'],
-            'properties.hs_object_id': ['101', '102', float('nan')],
-            'properties.hs_email_to_email': ['contact1@example.com', 'contact2@example.com', 'contact3@example.com']
-        })
+        # Fecha ISO
+        self.assertEqual(format_date('2021-03-22T15:00:00'), '2021-03-22 15:00:00')
         
-        contacts_df = pd.DataFrame({
-            'id': ['201', '202'],
-            'properties.email': ['contact1@example.com', 'contact2@example.com'],
-            'properties.associatedcompanyid': ['301', '302'],
-            'firstname': ['John', 'Jane'],
-            'lastname': ['Doe', 'Smith']
-        })
-        
-        mock_read_csv.side_effect = [emails_df, contacts_df]
-        
-        # Configurar respuestas para get_company
-        def mock_get_company_side_effect(company_id):
-            company_data = {
-                '301': {'properties': {'name': 'Company A', 'domain': 'companya.com'}},
-                '302': {'properties': {'name': 'Company B', 'domain': 'companyb.com'}}
-            }
-            return company_data.get(company_id, {})
+        # Valores sin fecha
+        self.assertEqual(format_date(None), 'Unknown')
+        self.assertEqual(format_date('not a date'), 'not a date')
+
+class TestSaveEmailContent(unittest.TestCase):
+    """Pruebas para save_email_content; cada escenario es una prueba propia para que
+    pytest-xdist pueda repartirlos entre workers."""
+    
+    def setUp(self):
+        """Evita tocar el disco: open se parchea en cada prueba y ensure_directory no crea directorios."""
+        self.base_dir = "/fake/tmp"
+        get_email_directory.cache_clear()
+        self.addCleanup(get_email_directory.cache_clear)
+        ensure_directory_patcher = patch('hubspot.email_processor.ensure_directory', side_effect=Path)
+        ensure_directory_patcher.start()
+        self.addCleanup(ensure_directory_patcher.stop)
+    
+    def test_save_email_content_success(self):
+        """Prueba de guardado exitoso."""
+        # open se sustituye por una función que solo anota la ruta, sin recorrer call_args del mock
+        fake_file = FakeOpen()
+        captured_paths = []
         
-        mock_get_company.side_effect = mock_get_company_side_effect
+        def fake_open(path, *args, **kwargs):
+            captured_paths.append(path)
+            return fake_file
         
-        # Configurar respuestas para get_email_content
-        def mock_get_email_side_effect(email_id):
-            email_data = {
-                '101': {
-                    'id': '101',
-                    'properties': {
-                        'hs_email_subject': 'Email 1',
-                        'hs_email_text': 'Content 1',
-                        'hs_timestamp': '1616432400000'
-                    }
-                },
-                '102': {
-                    'id': '102',
-                    'properties': {
-                        'hs_email_subject': 'Email 2',
-                        'hs_email_text': 'Content 2',
-                        'hs_timestamp': '1616518800000'
-                    }
-                }
-            }
-            return email_data.get(email_id, {})
+        with patch('builtins.open', new=fake_open):
+            result = save_email_content(EMAIL_DATA, CONTACT_INFO, COMPANY_INFO, self.base_dir)
+        self.assertTrue(result)
+        self.assertEqual(len(captured_paths), 1)
         
-        mock_get_email.side_effect = mock_get_email_side_effect
+        # Verificar que se llamó con los argumentos correctos
+        # En lugar de verificar la ruta exacta, verificamos que contenga partes clave
+        # (carpeta de empresa, carpeta del destinatario y nombre basado en el ID)
+        file_path = str(captured_paths[0])
+        self.assertIn('Test Company', file_path)
+        self.assertIn('test@example.com', file_path)
+        self.assertIn('12345.txt', file_path)
         
-        # Configurar save_email_content para devolver True
-        mock_save.return_value = True
+        # Verificar que se escribió el contenido correcto (cabecera de 5 líneas y cuerpo)
+        content = fake_file.buf.getvalue()
+        self.assertGreaterEqual(content.count('\n'), 6)
+        self.assertTrue(content.startswith("Subject: Test Subject\nFrom: sender@example.com\n"))
+        self.assertIn("Email ID: 12345\n", content)
+        self.assertTrue(content.endswith("=" * 50 + "\n\nThis is a test email content."))
+    
+    def test_save_email_content_no_text(self):
+        """Prueba con email sin contenido: no se guarda nada."""
+        email_data_no_text = dict(EMAIL_DATA, properties={**EMAIL_DATA['properties'], 'hs_email_text': None})
         
-        # Ejecutar la función
-        download_email_contents('test_emails.csv', '/tmp/output', False)
+        result = save_email_content(email_data_no_text, CONTACT_INFO, COMPANY_INFO, self.base_dir)
+        self.assertFalse(result)
+    
+    def test_save_email_content_open_error(self):
+        """Prueba con error al abrir el archivo."""
+        with patch('builtins.open', side_effect=Exception("Test error")):
+            result = save_email_content(EMAIL_DATA, CONTACT_INFO, COMPANY_INFO, self.base_dir)
+            self.assertFalse(result)
+
+class FakeExecutor:
+    """Sustituto de un Executor que anota las tareas enviadas sin ejecutarlas."""
+    
+    def __init__(self):
+        self.submitted = []
+    
+    def submit(self, fn, *args):
+        self.submitted.append((fn, *args))
+
+class TestSummarizeSavedEmail(unittest.TestCase):
+    """Pruebas para summarize_saved_email."""
+    
+    def setUp(self):
+        """Crea un email guardado en un directorio temporal y parchea process_email_file."""
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.file_path = Path(temp_dir.name) / '12345.txt'
+        self.file_path.write_text('Email', encoding='utf-8')
+        process_patcher = patch('hubspot.email_processor.process_email_file')
+        self.mock_process = process_patcher.start()
+        self.addCleanup(process_patcher.stop)
+    
+    def test_summarize_in_executor(self):
+        """Con executor, el resumen se envía en segundo plano una sola vez por ejecución."""
+        executor = FakeExecutor()
+        submitted_summaries = set()
         
-        # Verificaciones
-        mock_ensure_dir.assert_called_once_with('/tmp/output')
-        self.assertEqual(mock_read_csv.call_count, 2)
+        # La segunda llamada simula otra fila del CSV con el mismo email, antes de que
+        # el resumen en segundo plano haya terminado
+        summarize_saved_email(self.file_path, executor, submitted_summaries)
+        summarize_saved_email(self.file_path, executor, submitted_summaries)
         
-        # Debe haber llamadas a get_company para cada contacto válido con compañía
-        self.assertTrue(mock_get_company.call_count >= 2)
+        self.assertEqual(executor.submitted, [(self.mock_process, self.file_path)])
+        self.mock_process.assert_not_called()
+    
+    def test_summarize_inline(self):
+        """Sin executor, el resumen se genera en el momento."""
+        summarize_saved_email(self.file_path)
+        self.mock_process.assert_called_once_with(self.file_path)
+    
+    def test_summary_exists(self):
+        """Si el email ya tiene resumen no se genera otro."""
+        self.file_path.with_suffix('.summary.json').write_text('{}', encoding='utf-8')
+        executor = FakeExecutor()
         
-        # Debe haber 3 llamadas a get_email_content (una por cada email en el DataFrame)
-        self.assertEqual(mock_get_email.call_count, 3)
+        summarize_saved_email(self.file_path, executor, set())
+        summarize_saved_email(self.file_path)
         
-        # Debe haber 2 llamadas a save_email_content (una por cada email válido)
-        self.assertEqual(mock_save.call_count, 2)
+        self.assertEqual(executor.submitted, [])
+        self.mock_process.assert_not_called()
+
+@pytest.fixture(scope="module")
+def email_env():
+    """Parchea las dependencias de download_email_contents una sola vez por módulo.
+    
+    Devuelve un SimpleNamespace con los mocks y fakes; el coste de construirlos no
+    crece con el número de pruebas. pd.read_csv no se parchea aquí: es el de pandas
+    para todos los módulos, así que lo parchea download_env solo durante cada prueba.
+    """
+    # Las dependencias que solo necesitan responder se sustituyen por funciones
+    # simples (new=...), sin construir un MagicMock
+    fake_get_email = FakeGetEmailContent()
+    with patch.multiple(
+        'hubspot.email_processor',
+        get_email_content=fake_get_email,
+        get_companies=DEFAULT,
+        save_email_content=DEFAULT,
+        ensure_directory=DEFAULT
+    ) as mocks:
+        yield SimpleNamespace(**mocks, get_email_content=fake_get_email)
+
+@pytest.fixture
+def download_env(email_env):
+    """Reinicia los mocks de email_env, configura sus respuestas y parchea pd.read_csv para cada prueba."""
+    for mock in (email_env.get_companies, email_env.save_email_content, email_env.ensure_directory):
+        mock.reset_mock(return_value=True, side_effect=True)
+    email_env.get_email_content.requested.clear()
+    
+    email_env.get_companies.return_value = {
+        '301': {'properties': {'name': 'Company A', 'domain': 'companya.com'}},
+        '302': {'properties': {'name': 'Company B', 'domain': 'companyb.com'}}
+    }
+    email_env.save_email_content.return_value = True
+    email_env.ensure_directory.return_value = Path('/tmp/test')
+    with patch('hubspot.email_processor.pd.read_csv', side_effect=[EMAILS_DF, CONTACTS_DF]) as mock_read_csv:
+        yield SimpleNamespace(**vars(email_env), read_csv=mock_read_csv)
+
+def test_download_email_contents(download_env):
+    """Prueba la función download_email_contents."""
+    mock_get_companies = download_env.get_companies
+    mock_save = download_env.save_email_content
+    
+    # Ejecutar la función
+    download_email_contents('test_emails.csv', '/tmp/output', False)
+    
+    # Verificaciones
+    download_env.ensure_directory.assert_called_once_with('/tmp/output')
+    assert download_env.read_csv.call_count == 2
+    
+    # Las empresas de todos los contactos se piden de una sola vez
+    mock_get_companies.assert_called_once()
+    assert sorted(mock_get_companies.call_args[0][0]) == ['301', '302']
+    
+    # Debe haber 2 llamadas a get_email_content (una por cada ID válido y único)
+    assert sorted(download_env.get_email_content.requested) == ['101', '102']
+    
+    # Debe haber 3 llamadas a save_email_content (una por cada fila con ID válido)
+    assert mock_save.call_count == 3
+    
+    # Cada email se asocia a su contacto y a la empresa de este
+    saved = {c[0][0]['id']: (c[0][1], c[0][2]) for c in mock_save.call_args_list}
+    assert saved['101'][0]['firstname'] == 'John'
+    assert saved['101'][1]['properties']['name'] == 'Company A'
+    assert saved['102'][0]['firstname'] == 'Jane'
+    assert saved['102'][1]['properties']['name'] == 'Company B'
+
+def test_download_email_contents_summary_concurrency(download_env):
+    """Con summarize, los resúmenes se generan en un pool del tamaño indicado."""
+    pool_sizes = []
+    
+    def recording_executor(max_workers):
+        pool_sizes.append(max_workers)
+        return ThreadPoolExecutor(max_workers=max_workers)
+    
+    with patch('hubspot.email_processor.ThreadPoolExecutor', side_effect=recording_executor):
+        download_email_contents('test_emails.csv', '/tmp/output', False, True, max_workers=4, summary_concurrency=3)
+    
+    # Un pool para las descargas y otro para los resúmenes
+    assert pool_sizes == [4, 3]
+    # Los resúmenes comparten el executor y el registro de emails ya enviados
+    summary_kwargs = download_env.save_email_content.call_args[1]
+    assert summary_kwargs['summary_executor'] is not None
+    assert summary_kwargs['submitted_summaries'] == set()
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,346 @@
+import re
+import json
+import unittest
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from hubspot.utils import EMAIL_BODY_SEPARATOR, TokenBucket
+from hubspot.summarizer import (
+    process_email_file, get_summary_cache_path, read_email_content, reserve_rate_limit,
+    truncate_email, build_multi_summary_request, SYSTEM_PROMPT, MULTI_EMAIL_SYSTEM_PROMPT,
+    TRUNCATED_MARKER,
+    find_email_files, process_emails_in_directory, submit_batch, split_batch_lines
+)
+
+def write_email(directory: Path, email_id: str, body: str, subject: str = "Test Subject",
+                to: str = "test@example.com") -> Path:
+    """Escribe un email con el mismo formato que save_email_content."""
+    email_path = directory / f"{email_id}.txt"
+    email_path.write_text(
+        f"Subject: {subject}\nFrom: sender@example.com\nTo: {to}\n"
+        f"Date: 2021-03-22 15:00:00\nEmail ID: {email_id}\n{EMAIL_BODY_SEPARATOR}{body}",
+        encoding='utf-8'
+    )
+    return email_path
+
+class FakeAsyncOpenAI:
+    """Sustituto de AsyncOpenAI que responde a cada petición con answer(ids).
+    
+    answer recibe los IDs (---ID:<id>---) de los emails de la petición y devuelve
+    el contenido del mensaje de respuesta.
+    """
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **request):
+        self.requests.append(request)
+        ids = re.findall(r'---ID:(.+?)---', request["messages"][1]["content"])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self.answer(ids)))])
+
+    async def close(self):
+        pass
+
+def answer_all(ids):
+    """Respuesta bien formada con un resumen por email."""
+    return json.dumps({"summaries": [{"id": email_id, "summary": f"Resumen {email_id}"} for email_id in ids]})
+
+class TestSummaryCache(unittest.TestCase):
+    """Pruebas para la caché de resúmenes indexada por el contenido del email."""
+
+    def setUp(self):
+        """Usa un directorio temporal para los emails y la caché de resúmenes."""
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        cache_patcher = patch('hubspot.summarizer.SUMMARY_CACHE_DIR', self.temp_dir / 'cache')
+        cache_patcher.start()
+        self.addCleanup(cache_patcher.stop)
+
+    def test_cache_key_ignores_only_email_id(self):
+        """La clave cubre todo lo que ve el modelo salvo el ID de HubSpot."""
+        def cache_path(*args, **kwargs):
+            return get_summary_cache_path(read_email_content(write_email(self.temp_dir, *args, **kwargs)))
+
+        first = cache_path('1', 'Same body')
+        self.assertEqual(first, cache_path('2', 'Same body'))
+        self.assertNotEqual(first, cache_path('3', 'Other body'))
+        # El asunto y los destinatarios forman parte del prompt, así que también de la clave
+        self.assertNotEqual(first, cache_path('4', 'Same body', subject='Other Subject'))
+        self.assertNotEqual(first, cache_path('5', 'Same body', to='other@example.com'))
+
+    def test_read_email_content_removes_email_id(self):
+        """El contenido que se envía al modelo no incluye la línea del ID, pero sí el resto."""
+        email_content = read_email_content(write_email(self.temp_dir, '12345', 'Email ID: 1 en el cuerpo'))
+
+        self.assertNotIn("Email ID: 12345", email_content)
+        self.assertIn("Subject: Test Subject\n", email_content)
+        self.assertIn("Date: 2021-03-22 15:00:00\n", email_content)
+        self.assertTrue(email_content.endswith(EMAIL_BODY_SEPARATOR + 'Email ID: 1 en el cuerpo'))
+
+    def test_cache_key_depends_on_system_prompt(self):
+        """Un resumen de la petición de un solo email no se reutiliza en la de varios."""
+        single = get_summary_cache_path('Same body', SYSTEM_PROMPT)
+        self.assertEqual(single, get_summary_cache_path('Same body'))
+        self.assertNotEqual(single, get_summary_cache_path('Same body', MULTI_EMAIL_SYSTEM_PROMPT))
+
+    @patch('hubspot.summarizer.MAX_PROMPT_CHARS', 10)
+    def test_read_email_content_truncates(self):
+        """Un email más largo que el límite se recorta y se marca como truncado."""
+        email_content = read_email_content(write_email(self.temp_dir, '1', 'x' * 100))
+
+        self.assertEqual(email_content, "Subject: T" + TRUNCATED_MARKER)
+
+    def test_truncate_email(self):
+        """La marca se añade al recortar y se conserva, sin duplicarse, al recortar de nuevo."""
+        self.assertEqual(truncate_email('abc', 3), 'abc')
+        self.assertEqual(truncate_email('abcdef', 3), 'abc' + TRUNCATED_MARKER)
+        self.assertEqual(truncate_email('abcdef' + TRUNCATED_MARKER, 3), 'abc' + TRUNCATED_MARKER)
+        self.assertEqual(truncate_email('abc' + TRUNCATED_MARKER, 10), 'abc' + TRUNCATED_MARKER)
+
+    @patch('hubspot.summarizer.MAX_EMAIL_CHARS', 3)
+    def test_multi_summary_request_keeps_marker(self):
+        """La petición de varios emails marca como truncado el email que recorta."""
+        request = build_multi_summary_request([('1', 'abcdef'), ('2', 'ab')])
+
+        self.assertEqual(request["messages"][1]["content"],
+                         f"---ID:1---\nabc{TRUNCATED_MARKER}\n\n---ID:2---\nab")
+
+    @patch('hubspot.summarizer.summarize_email')
+    def test_same_body_costs_one_api_call(self, mock_summarize):
+        """Dos emails con distinto ID y el mismo cuerpo se resumen con una sola llamada."""
+        mock_summarize.return_value = {"summary": "Resumen", "model": "test", "timestamp": 0}
+        first = write_email(self.temp_dir, '1', 'Same body')
+        second = write_email(self.temp_dir, '2', 'Same body')
+
+        self.assertTrue(process_email_file(first))
+        self.assertTrue(process_email_file(second))
+
+        mock_summarize.assert_called_once()
+        self.assertTrue(first.with_suffix('.summary.json').exists())
+        self.assertTrue(second.with_suffix('.summary.json').exists())
+
+class TestRateLimit(unittest.TestCase):
+    """Pruebas para los límites de las peticiones a OpenAI."""
+
+    @patch('hubspot.utils.time.monotonic', return_value=1000.0)
+    def test_reserve_rate_limit(self, mock_monotonic):
+        """Los tokens se estiman como caracteres del prompt / 4 más max_tokens."""
+        request_bucket, token_bucket = TokenBucket(60, 60, 10), TokenBucket(6000, 60, 1000)
+        request = {
+            "messages": [{"role": "system", "content": "a" * 100}, {"role": "user", "content": "b" * 300}],
+            "max_tokens": 500
+        }
+
+        with patch('hubspot.summarizer.REQUEST_BUCKET', request_bucket), \
+                patch('hubspot.summarizer.TOKEN_BUCKET', token_bucket):
+            # Caben en los dos buckets: no se espera
+            self.assertEqual(reserve_rate_limit(request), 0.0)
+            self.assertEqual(request_bucket.tokens, 9)
+            self.assertEqual(token_bucket.tokens, 1000 - (400 // 4 + 500))
+
+            # Se espera lo que pida el bucket más restrictivo (aquí, el de tokens)
+            token_bucket.tokens = 0.0
+            self.assertAlmostEqual(reserve_rate_limit(request), 600 / token_bucket.refill_rate)
+
+class TestProcessEmailsInDirectory(unittest.TestCase):
+    """Pruebas para process_emails_in_directory con peticiones de varios emails."""
+
+    def setUp(self):
+        """Crea tres emails (uno en un subdirectorio) en un directorio temporal."""
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        (self.temp_dir / 'company' / 'contact').mkdir(parents=True)
+        self.email_paths = [
+            write_email(self.temp_dir, '1', 'Body 1'),
+            write_email(self.temp_dir / 'company', '2', 'Body 2'),
+            write_email(self.temp_dir / 'company' / 'contact', '3', 'Body 3'),
+        ]
+
+        for patcher in (patch('hubspot.summarizer.SUMMARY_CACHE_DIR', self.temp_dir / '.cache'),
+                        patch('hubspot.summarizer.reserve_rate_limit', return_value=0.0)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_with_client(self, client):
+        """Procesa el directorio temporal usando client como cliente asíncrono de OpenAI."""
+        with patch('hubspot.summarizer.get_async_openai_client', return_value=client):
+            return process_emails_in_directory(str(self.temp_dir))
+
+    def test_find_email_files(self):
+        """Encuentra los emails de todos los subdirectorios y los que ya tienen resumen."""
+        self.email_paths[1].with_suffix('.summary.json').write_text('{}', encoding='utf-8')
+
+        email_files, summarized = find_email_files(str(self.temp_dir))
+
+        self.assertEqual(sorted(email_files), sorted(str(path) for path in self.email_paths))
+        self.assertEqual(summarized, {str(self.email_paths[1].with_suffix(''))})
+
+    def test_well_formed_response(self):
+        """Todos los emails se resumen con una sola petición y cada resumen va a su email."""
+        client = FakeAsyncOpenAI(answer_all)
+
+        stats = self.run_with_client(client)
+
+        self.assertEqual(stats, {"total": 3, "processed": 3, "skipped": 0, "errors": 0})
+        self.assertEqual(len(client.requests), 1)
+        self.assertEqual(client.requests[0]["response_format"], {"type": "json_object"})
+        summaries = sorted(
+            json.loads(path.with_suffix('.summary.json').read_text(encoding='utf-8'))["summary"]
+            for path in self.email_paths
+        )
+        # Los IDs de la petición son posiciones, no IDs de HubSpot
+        self.assertEqual(summaries, ["Resumen 0", "Resumen 1", "Resumen 2"])
+
+    def test_skips_summarized_emails(self):
+        """Los emails que ya tienen resumen se cuentan como omitidos y no se envían."""
+        self.email_paths[0].with_suffix('.summary.json').write_text('{}', encoding='utf-8')
+        client = FakeAsyncOpenAI(answer_all)
+
+        stats = self.run_with_client(client)
+
+        self.assertEqual(stats, {"total": 3, "processed": 2, "skipped": 1, "errors": 0})
+        self.assertEqual(len(re.findall('---ID:', client.requests[0]["messages"][1]["content"])), 2)
+
+    def test_response_missing_id(self):
+        """Un email sin resumen en la respuesta cuenta como error."""
+        client = FakeAsyncOpenAI(lambda ids: answer_all(ids[:-1]))
+
+        stats = self.run_with_client(client)
+
+        self.assertEqual(stats, {"total": 3, "processed": 2, "skipped": 0, "errors": 1})
+        self.assertEqual(sum(path.with_suffix('.summary.json').exists() for path in self.email_paths), 2)
+
+    def test_response_not_json(self):
+        """Si la respuesta no es JSON, ningún email del grupo se resume."""
+        client = FakeAsyncOpenAI(lambda ids: "Esto no es JSON")
+
+        stats = self.run_with_client(client)
+
+        self.assertEqual(stats, {"total": 3, "processed": 0, "skipped": 0, "errors": 3})
+        self.assertFalse(any(path.with_suffix('.summary.json').exists() for path in self.email_paths))
+
+class FakeBatchClient:
+    """Sustituto de OpenAI con files y batches en memoria.
+    
+    Todos los batches terminan en el estado status; la salida tiene una respuesta
+    correcta por petición salvo para los custom_id de failing, que dan error.
+    """
+
+    def __init__(self, status='completed', failing=(), malformed=()):
+        self.status = status
+        self.failing = set(failing)
+        self.malformed = set(malformed)
+        self.uploads = {}
+        self.files = SimpleNamespace(create=self.create_file, content=self.file_content)
+        self.batches = SimpleNamespace(create=self.create_batch, retrieve=self.retrieve_batch)
+
+    def create_file(self, file, purpose):
+        file_id = f"file-{len(self.uploads)}"
+        self.uploads[file_id] = file[1].decode('utf-8').splitlines()
+        return SimpleNamespace(id=file_id)
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        return SimpleNamespace(id=f"batch-{input_file_id}")
+
+    def retrieve_batch(self, batch_id):
+        input_file_id = batch_id[len("batch-"):]
+        output_file_id = f"output-{input_file_id}" if self.status == 'completed' else None
+        return SimpleNamespace(id=batch_id, status=self.status, output_file_id=output_file_id)
+
+    def file_content(self, output_file_id):
+        rows = []
+        for line in self.uploads[output_file_id[len("output-"):]]:
+            custom_id = json.loads(line)["custom_id"]
+            if custom_id in self.failing:
+                rows.append({"custom_id": custom_id, "response": None, "error": {"message": "Test error"}})
+            elif custom_id in self.malformed:
+                rows.append({"custom_id": custom_id, "error": None, "response": {"status_code": 200, "body": {}}})
+            else:
+                rows.append({"custom_id": custom_id, "error": None, "response": {
+                    "status_code": 200,
+                    "body": {"choices": [{"message": {"content": f"Resumen {custom_id}"}}]}
+                }})
+        return SimpleNamespace(text="\n".join(json.dumps(row) for row in rows))
+
+class TestSubmitBatch(unittest.TestCase):
+    """Pruebas para submit_batch con un cliente de la Batch API en memoria."""
+
+    def setUp(self):
+        """Crea tres emails en un directorio temporal."""
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        self.email_paths = [write_email(self.temp_dir, str(i), f"Body {i}") for i in range(3)]
+        cache_patcher = patch('hubspot.summarizer.SUMMARY_CACHE_DIR', self.temp_dir / '.cache')
+        cache_patcher.start()
+        self.addCleanup(cache_patcher.stop)
+
+    def run_with_client(self, client):
+        """Ejecuta submit_batch usando client como cliente de OpenAI."""
+        with patch('hubspot.summarizer.get_openai_client', return_value=client):
+            return submit_batch(self.email_paths)
+
+    def test_success_and_error_rows(self):
+        """Las filas correctas se guardan y las filas con error cuentan como fallo."""
+        client = FakeBatchClient(failing={'1'})
+
+        results = self.run_with_client(client)
+
+        self.assertEqual(results, [True, False, True])
+        self.assertEqual(len(client.uploads), 1)
+        summary = json.loads(self.email_paths[2].with_suffix('.summary.json').read_text(encoding='utf-8'))
+        self.assertEqual(summary["summary"], "Resumen 2")
+        self.assertFalse(self.email_paths[1].with_suffix('.summary.json').exists())
+
+    def test_bad_rows_do_not_stop_the_batch(self):
+        """Una fila sin choices, con un custom_id desconocido o que no es JSON no pierde las demás."""
+        client = FakeBatchClient(malformed={'0'})
+        original_content = client.file_content
+
+        def file_content(output_file_id):
+            text = original_content(output_file_id).text
+            return SimpleNamespace(text='no es JSON\n{"custom_id": "99", "response": {"status_code": 200}}\n' + text)
+
+        client.files.content = file_content
+
+        results = self.run_with_client(client)
+
+        self.assertEqual(results, [False, True, True])
+
+    def test_batch_not_completed(self):
+        """Si el batch no termina en 'completed', no se guarda ningún resumen."""
+        results = self.run_with_client(FakeBatchClient(status='failed'))
+
+        self.assertEqual(results, [False, False, False])
+        self.assertFalse(any(path.with_suffix('.summary.json').exists() for path in self.email_paths))
+
+    def test_split_by_request_limit(self):
+        """Las peticiones se reparten en varios batches al superar BATCH_MAX_REQUESTS."""
+        client = FakeBatchClient()
+
+        with patch('hubspot.summarizer.BATCH_MAX_REQUESTS', 2):
+            results = self.run_with_client(client)
+
+        self.assertEqual(results, [True, True, True])
+        self.assertEqual([len(lines) for lines in client.uploads.values()], [2, 1])
+
+    def test_split_batch_lines(self):
+        """Los grupos respetan BATCH_MAX_BYTES contando el salto de línea de cada petición."""
+        lines = [b"a" * 9] * 5
+
+        # Cada línea ocupa 10 bytes con su salto de línea: caben dos por grupo
+        with patch('hubspot.summarizer.BATCH_MAX_BYTES', 25):
+            self.assertEqual([len(group) for group in split_batch_lines(lines)], [2, 2, 1])
+
+        # Una línea mayor que el límite va sola en su grupo en lugar de perderse
+        with patch('hubspot.summarizer.BATCH_MAX_BYTES', 5):
+            self.assertEqual([len(group) for group in split_batch_lines(lines)], [1, 1, 1, 1, 1])
+
+if __name__ == "__main__":
+    unittest.main()
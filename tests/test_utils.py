@@ -1,95 +1,139 @@
 import unittest
 import os
-import tempfile
+import pytest
+from pyfakefs import fake_filesystem_unittest
 from pathlib import Path
-from hubspot.utils import sanitize_filename, get_email_filename, ensure_directory
+from datetime import datetime
+from unittest.mock import patch
+from hubspot.utils import sanitize_filename, get_email_filename, ensure_directory, parse_date_for_filename, TokenBucket
+
+# Casos de sanitize_filename (entrada, resultado esperado); tupla creada una sola vez al importar
+SANITIZE_CASES = (
+    ("normal name", "normal name"),
+    ("name/with/slashes", "name_with_slashes"),
+    ("name:with:colons", "name_with_colons"),
+    ("name<with>brackets", "name_with_brackets"),
+    ("name?with*wildcards", "name_with_wildcards"),
+    ('name"with\'quotes', "name_with_quotes"),  # Corregido para usar comillas simples
+    ("", "unknown"),
+    (None, "unknown"),  # Manejar None correctamente
+    ("   ", "unknown"),
+)
+
+@pytest.mark.parametrize("input_name,expected", SANITIZE_CASES)
+def test_sanitize_filename(input_name, expected):
+    """Prueba la función sanitize_filename."""
+    assert sanitize_filename(input_name) == expected
+
+@pytest.mark.parametrize("properties,email_id,expected", [
+    ({"hs_timestamp": "1616432400000", "hs_email_subject": "Test Subject"}, "12345", "12345.txt"),
+    ({"hs_timestamp": "1616432400000", "hs_email_subject": "Test Subject"}, "987", "987.txt"),
+    ({"hs_email_subject": "Test Subject"}, "12345", "12345.txt"),  # Sin timestamp
+    ({"hs_timestamp": "1616432400000"}, "12345", "12345.txt"),  # Sin asunto
+    ({"hs_timestamp": "1616432400000", "hs_email_subject": "A" * 100}, "12345", "12345.txt"),  # Asunto muy largo
+    ({}, "55501", "55501.txt"),
+])
+def test_get_email_filename(properties, email_id, expected):
+    """Prueba la función get_email_filename: el nombre es el ID de HubSpot, sea cual sea
+    la fecha o el asunto, por lo que no depende de la zona horaria."""
+    assert get_email_filename(properties, email_id) == expected
 
 class TestUtils(unittest.TestCase):
     """Pruebas para las funciones de utilidad."""
 
-    def test_sanitize_filename(self):
-        """Prueba la función sanitize_filename."""
-        # Casos de prueba
-        test_cases = [
-            ("normal name", "normal name"),
-            ("name/with/slashes", "name_with_slashes"),
-            ("name:with:colons", "name_with_colons"),
-            ("name<with>brackets", "name_with_brackets"),
-            ("name?with*wildcards", "name_with_wildcards"),
-            ('name"with\'quotes', "name_with_quotes"),  # Corregido para usar comillas simples
-            ("", "unknown"),
-            (None, "unknown"),  # Manejar None correctamente
-            ("   ", "unknown")
-        ]
+    def test_parse_date_for_filename(self):
+        """Prueba la función parse_date_for_filename."""
+        # Fechas ISO (camino rápido con fromisoformat y fallback con dateutil)
+        self.assertEqual(parse_date_for_filename("2021-03-22T15:00:00Z"), "20210322_150000")
+        self.assertEqual(parse_date_for_filename("2021-03-22 15:00:00.123+01:00"), "20210322_150000")
+        self.assertEqual(parse_date_for_filename("2021-03-22"), "20210322_000000")
+        
+        # Timestamps en ms (numéricos o como cadena); se convierten a hora local,
+        # así que el valor esperado se calcula igual para no depender de la zona horaria
+        expected = datetime.fromtimestamp(1616432400).strftime('%Y%m%d_%H%M%S')
+        for value in (1616432400000, 1616432400000.0, "1616432400000"):
+            with self.subTest(value=value):
+                self.assertEqual(parse_date_for_filename(value), expected)
         
-        for input_name, expected in test_cases:
-            with self.subTest(input_name=input_name):
-                # Para el caso None, verificamos que se maneje correctamente
-                if input_name is None:
-                    self.assertEqual(sanitize_filename(input_name), "unknown")
-                else:
-                    result = sanitize_filename(input_name)
-                    self.assertEqual(result, expected)
+        # Valores no válidos
+        for value in (None, "abc", float('nan')):
+            with self.subTest(value=value):
+                self.assertEqual(parse_date_for_filename(value), "unknown_date")
     
-    def test_get_email_filename(self):
-        """Prueba la función get_email_filename."""
-        # Caso con timestamp y asunto
-        properties = {
-            "hs_timestamp": "1616432400000",  # 2021-03-22 15:00:00 UTC
-            "hs_email_subject": "Test Subject"
-        }
-        email_id = "12345"
-        result = get_email_filename(properties, email_id)
+class TestTokenBucket(unittest.TestCase):
+    """Pruebas para el token bucket compartido por los límites de HubSpot y OpenAI."""
+    
+    @patch('hubspot.utils.time.monotonic')
+    def test_reserve(self, mock_monotonic):
+        """Prueba TokenBucket.reserve."""
+        now = 1000.0
+        mock_monotonic.return_value = now
+        # 60 tokens por minuto con ráfaga de 10: se reponen 50 por minuto
+        bucket = TokenBucket(60, 60, 10)
+        refill_rate = 50 / 60
         
-        # Verificar que el formato es correcto, pero sin verificar la hora exacta
-        # ya que puede variar según la zona horaria
-        self.assertTrue(result.startswith("20210322_"))
-        self.assertTrue("_Test Subject_12345.txt" in result)
+        # Caso 1: Bucket lleno, no se espera y se consume un token
+        self.assertEqual(bucket.reserve(1), 0.0)
+        self.assertEqual(bucket.tokens, 9)
         
-        # Caso sin timestamp
-        properties = {
-            "hs_email_subject": "Test Subject"
-        }
-        result = get_email_filename(properties, email_id)
-        self.assertEqual(result, "unknown_date_Test Subject_12345.txt")
+        # Caso 2: Bucket vacío, se espera lo necesario para un token
+        bucket.tokens, bucket.last_refill = 0.0, now
+        self.assertAlmostEqual(bucket.reserve(1), 1 / refill_rate)
         
-        # Caso sin asunto
-        properties = {
-            "hs_timestamp": "1616432400000"
-        }
-        result = get_email_filename(properties, email_id)
-        self.assertTrue(result.startswith("20210322_"))
-        self.assertTrue("_no_subject_12345.txt" in result)
+        # Caso 3: Bucket vacío pero ha pasado una ventana completa, se rellena solo hasta la ráfaga
+        bucket.tokens, bucket.last_refill = 0.0, now - 60
+        self.assertEqual(bucket.reserve(1), 0.0)
+        self.assertEqual(bucket.tokens, 9)
         
-        # Caso con asunto muy largo
-        properties = {
-            "hs_timestamp": "1616432400000",
-            "hs_email_subject": "A" * 100
-        }
-        result = get_email_filename(properties, email_id)
-        self.assertTrue(len(result.split("_")[2]) <= 50)
+        # Caso 4: Ya hay una petición esperando, la siguiente espera el doble
+        bucket.tokens, bucket.last_refill = -1.0, now
+        self.assertAlmostEqual(bucket.reserve(1), 2 / refill_rate)
+    
+    @patch('hubspot.utils.time.monotonic', return_value=1000.0)
+    def test_window_limit(self, mock_monotonic):
+        """Con el bucket lleno, la ráfaga más lo repuesto en una ventana no supera el límite."""
+        bucket = TokenBucket(60, 60, 10)
+        
+        # Momento en que se concede cada uno de 200 tokens pedidos a la vez
+        grants = [1000.0 + bucket.reserve(1) for _ in range(200)]
+        
+        self.assertLessEqual(sum(1 for grant in grants if grant - 1000.0 < 60), 60)
+    
+class TestEnsureDirectory(fake_filesystem_unittest.TestCase):
+    """Pruebas para ensure_directory sobre un sistema de archivos en memoria (pyfakefs)."""
+    
+    def setUp(self):
+        self.setUpPyfakefs()
+        # Los directorios memorizados en otras pruebas no existen en el sistema falso
+        ensure_directory.cache_clear()
+        self.addCleanup(ensure_directory.cache_clear)
     
     def test_ensure_directory(self):
         """Prueba la función ensure_directory."""
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Probar creación de directorio simple
-            test_dir = os.path.join(temp_dir, "test_dir")
-            dir_path = ensure_directory(test_dir)
-            self.assertTrue(os.path.exists(test_dir))
-            self.assertTrue(os.path.isdir(test_dir))
-            self.assertEqual(dir_path, Path(test_dir))
-            
-            # Probar creación de directorio anidado
-            nested_dir = os.path.join(temp_dir, "parent/child/grandchild")
-            dir_path = ensure_directory(nested_dir)
-            self.assertTrue(os.path.exists(nested_dir))
-            self.assertTrue(os.path.isdir(nested_dir))
-            self.assertEqual(dir_path, Path(nested_dir))
-            
-            # Probar que no falla si el directorio ya existe
-            dir_path = ensure_directory(nested_dir)
-            self.assertTrue(os.path.exists(nested_dir))
-            self.assertEqual(dir_path, Path(nested_dir))
+        temp_dir = '/tmp'
+        # Probar creación de directorio simple
+        test_dir = os.path.join(temp_dir, "test_dir")
+        dir_path = ensure_directory(test_dir)
+        self.assertTrue(os.path.exists(test_dir))
+        self.assertTrue(os.path.isdir(test_dir))
+        self.assertEqual(dir_path, Path(test_dir))
+        
+        # Probar creación de directorio anidado
+        nested_dir = os.path.join(temp_dir, "parent/child/grandchild")
+        dir_path = ensure_directory(nested_dir)
+        self.assertTrue(os.path.exists(nested_dir))
+        self.assertTrue(os.path.isdir(nested_dir))
+        self.assertEqual(dir_path, Path(nested_dir))
+        
+        # Probar que no falla si el directorio ya existe
+        dir_path = ensure_directory(nested_dir)
+        self.assertTrue(os.path.exists(nested_dir))
+        self.assertEqual(dir_path, Path(nested_dir))
+        
+        # Probar que un directorio ya asegurado no vuelve a crearse
+        with patch('hubspot.utils.Path.mkdir') as mock_mkdir:
+            ensure_directory(nested_dir)
+            mock_mkdir.assert_not_called()
 
 if __name__ == "__main__":
     unittest.main()